@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import os.path as osp
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from tqdm import tqdm
+from util.descriptor_store import append_npy, compact_npy
+from util.incremental import scan_images
+
+CACHE_SIZE = (256, 128)
+CACHE_ARRAYS = ['images', 'img_names', 'mtimes', 'sizes', 'person_ids', 'camera_ids']
+
+
+class NormalizeUint8(object):
+    """Converts a uint8 image tensor to float and normalizes it in a single addcmul"""
+
+    def __init__(self, mean, std):
+        self.scale = (1. / (255. * torch.tensor(std))).view(-1, 1, 1)
+        self.shift = (-torch.tensor(mean) / torch.tensor(std)).view(-1, 1, 1)
+
+    def __call__(self, img):
+        return torch.addcmul(self.shift, img.to(torch.float32), self.scale)
+
+    def __repr__(self):
+        return '{}(scale={}, shift={})'.format(self.__class__.__name__, self.scale.view(-1).tolist(), self.shift.view(-1).tolist())
+
+
+class Decode_loader(torch.utils.data.Dataset):
+    """Decodes and resizes images to CACHE_SIZE uint8 3 x H x W tensors"""
+
+    def __init__(self, root_dir, img_names):
+        self.root_dir = root_dir
+        self.img_names = img_names
+        self.resize = transforms.Resize(CACHE_SIZE)
+
+    def __len__(self):
+        return len(self.img_names)
+
+    def __getitem__(self, idx):
+        img = self.resize(Image.open(osp.join(self.root_dir, self.img_names[idx])).convert('RGB'))
+        return torch.from_numpy(np.asarray(img).transpose(2, 0, 1).copy())
+
+
+class ImageCache():
+    """Memory-mapped N x 3 x 256 x 128 uint8 array of pre-decoded images with a label table
+
+    The cache directory holds images.npy, img_names.npy, mtimes.npy and sizes.npy (of the
+    decoded files), person_ids.npy, camera_ids.npy and header.json with the image folder
+    it was built from. The memory map is opened
+    lazily so the cache can be sent to DataLoader workers without copying it.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        with open(osp.join(cache_path, 'header.json')) as f:
+            self.header = json.load(f)
+        self.img_names = np.load(osp.join(cache_path, 'img_names.npy'))
+        self.mtimes = np.load(osp.join(cache_path, 'mtimes.npy'))
+        self.sizes = np.load(osp.join(cache_path, 'sizes.npy'))
+        self.index = {name: i for i, name in enumerate(self.img_names)}
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(osp.join(self.cache_path, 'images.npy'), mmap_mode = 'r')
+        return self._images
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_images'] = None
+        return state
+
+    def get_rows(self, img_names):
+        return np.array([self.index[name] for name in img_names], dtype = np.int64)
+
+
+def decode_images(root_dir, img_names, num_workers = 0):
+    images = np.zeros((len(img_names), 3) + CACHE_SIZE, dtype = np.uint8)
+    dataloader = torch.utils.data.DataLoader(Decode_loader(root_dir, img_names), batch_size = 64, num_workers = num_workers)
+    start = 0
+    for batch in tqdm(dataloader, desc = 'Caching {}'.format(root_dir)):
+        images[start:start + len(batch)] = batch.numpy()
+        start += len(batch)
+    return images
+
+
+def get_image_cache(cache_dir, root_dir, img_names, num_workers = 0):
+    """Returns the image cache of root_dir in cache_dir, decoding only images not cached yet
+
+    Rows of files that were deleted or changed (other modification time or size) are
+    dropped, images missing from the cache are decoded and appended to it; the cache is
+    rebuilt if it was made for another folder. The cache folder is named after the last
+    two components of root_dir and a hash of its absolute path, so folders with the same
+    name under different roots get caches of their own.
+    """
+    root_path = osp.normpath(osp.abspath(root_dir))
+    cache_path = osp.join(cache_dir, '{}_{}'.format('_'.join(root_path.split(os.sep)[-2:]), hashlib.md5(root_path.encode()).hexdigest()[:8]))
+    header = {'root_dir': root_path, 'size': list(CACHE_SIZE), 'version': 2}
+    stats = {name: (mtime, size) for name, mtime, size in zip(*scan_images(root_dir))}
+
+    cache = ImageCache(cache_path) if osp.exists(osp.join(cache_path, 'header.json')) else None
+    if cache is not None and cache.header != header:
+        cache = None
+
+    if cache is not None:
+        keep = np.array([stats.get(name) == (mtime, size) for name, mtime, size in zip(cache.img_names, cache.mtimes, cache.sizes)], dtype = bool)
+        if not keep.all():
+            del cache
+            for key in CACHE_ARRAYS:
+                compact_npy(osp.join(cache_path, key + '.npy'), keep)
+            cache = ImageCache(cache_path)
+
+    missing = [name for name in img_names if cache is None or name not in cache.index]
+    if cache is not None and len(missing) == 0:
+        return cache
+
+    arrays = {'images': decode_images(root_dir, missing, num_workers),
+              'img_names': np.array(missing, dtype = str),
+              'mtimes': np.array([stats[name][0] for name in missing], dtype = np.int64),
+              'sizes': np.array([stats[name][1] for name in missing], dtype = np.int64),
+              'person_ids': np.array([int(name.split('_')[0]) for name in missing], dtype = np.int32),
+              'camera_ids': np.array([int(name.split('_')[1][1]) for name in missing], dtype = np.int32)}
+
+    if cache is None:
+        if not osp.exists(cache_path):
+            os.makedirs(cache_path)
+        for key in CACHE_ARRAYS:
+            np.save(osp.join(cache_path, key + '.npy'), arrays[key])
+        with open(osp.join(cache_path, 'header.json'), 'w') as f:
+            json.dump(header, f, indent = 4)
+    else:
+        for key in CACHE_ARRAYS:
+            append_npy(osp.join(cache_path, key + '.npy'), arrays[key])
+    return ImageCache(cache_path)
@@ -7,6 +7,8 @@ import torchvision.utils as vutils
 import torch
 from time import time
 from torchvision import transforms
+import numpy as np
+from data.cache import NormalizeUint8, get_image_cache
 
 class RandomErasing(object):
     def __init__(self, probability=0.4, er_area_min=0.02, er_area_max=0.4, asp_ratio=0.3,er_color=[150, 142, 129]):
@@ -30,7 +32,25 @@ class RandomErasing(object):
                     img[i, top_left[0]:top_left[0] + h, top_left[1]:top_left[1] + w] = self.erasing_color[i] / 255
         return img
 
-def get_transforms(dataset_type):
+    def __repr__(self):
+        return '{}(probability={}, area=({}, {}), aspect_ratio={}, color={})'.format(self.__class__.__name__, self.probability,
+                                                                                    self.erasing_area_min, self.erasing_area_max,
+                                                                                    self.aspect_ratio, self.erasing_color)
+
+def get_transforms(dataset_type, cached=False):
+    if cached:
+        # images come from an ImageCache as uint8 tensors already resized to 256x128
+        normalize = NormalizeUint8(mean=[0.485, 0.456, 0.406],
+                                   std=[0.229, 0.224, 0.225])
+        if dataset_type == "Train":
+            return transforms.Compose([
+                transforms.RandomCrop((246, 128)),
+                transforms.RandomRotation(15),
+                normalize,
+                RandomErasing()
+            ])
+        return normalize
+
     if dataset_type == "Train":
         transform_train = transforms.Compose([
             transforms.Resize((256, 128)),
@@ -51,9 +71,23 @@ def get_transforms(dataset_type):
         ])
         return transform_test
     
+def get_class_index(image_classes, total_ids):
+    """Returns image indexes grouped by class and the offsets of every class group in them"""
+    class_images = np.argsort(image_classes, kind='stable')
+    class_offsets = np.concatenate([[0], np.cumsum(np.bincount(image_classes, minlength=total_ids))])
+    return class_images, class_offsets
+
+def get_random_class_image_idx(class_images, class_offsets, class_id, same_class):
+    """Draws an image of class_id if same_class, otherwise an image of a uniformly drawn other class"""
+    if not same_class:
+        an_class = torch.randint(0, len(class_offsets) - 2, (1, )).item()
+        class_id = an_class + 1 if an_class >= class_id else an_class
+    start, end = class_offsets[class_id], class_offsets[class_id + 1]
+    return int(class_images[start + torch.randint(0, end - start, (1, )).item()])
+
 class Dataset_loader(torch.utils.data.Dataset):
     
-    def __init__(self, root='', dataset_type='Train', transform=None):
+    def __init__(self, root='', dataset_type='Train', transform=None, img_names=None, cache_dir=None, num_workers=0):
 
         self.dataset_type = dataset_type
         if dataset_type == 'Train':
@@ -69,7 +103,12 @@ class Dataset_loader(torch.utils.data.Dataset):
             raise Exception('Invalid dataset type')
 
         self.transform = transform
-        self.img_names = sorted(os.listdir(self.root_dir))
+        self.img_names = sorted(os.listdir(self.root_dir)) if img_names is None else list(img_names) # img_names restricts the dataset to given files
+
+        self.cache = None # pre-decoded uint8 images, see data/cache.py
+        if cache_dir is not None:
+            self.cache = get_image_cache(cache_dir, self.root_dir, self.img_names, num_workers)
+            self.cache_rows = self.cache.get_rows(self.img_names)
 
         self.data_to_id = {} # mapping from data person labels to training person labels
         self.id_to_data = {} # mapping from training person labels to data person labels
@@ -90,26 +129,25 @@ class Dataset_loader(torch.utils.data.Dataset):
                 self.id_to_images[person_id] = [i]
             else:
                 self.id_to_images[person_id].append(i) 
+
+        self.image_classes = np.array([self.data_to_id[int(name.split('_')[0])] for name in self.img_names], dtype=np.int64)
+        self.class_images, self.class_offsets = get_class_index(self.image_classes, self.total_ids)
                              
             
     def __len__(self):
         return len(self.img_names)
+
+    def get_image_class(self, idx):
+        return int(self.image_classes[idx])
     
     def get_random_class_image_idx(self, class_id, same_class):
-        if same_class:
-            l = self.id_to_images[self.id_to_data[class_id]]
-            ind = torch.randint(0, len(l), (1, )).item()
-            return l[ind]
-        else:
-            an_class = torch.randint(0, self.total_ids, (1, )).item()
-            while an_class == class_id:
-                an_class = torch.randint(0, self.total_ids, (1, )).item()
-            l = self.id_to_images[self.id_to_data[an_class]]
-            ind = torch.randint(0, len(l), (1, )).item()
-            return l[ind]
+        return get_random_class_image_idx(self.class_images, self.class_offsets, class_id, same_class)
     
     def __getitem__(self, idx):            
-        img = Image.open(os.path.join(self.root_dir, self.img_names[idx]))
+        if self.cache is not None:
+            img = torch.from_numpy(np.array(self.cache.images[self.cache_rows[idx]]))
+        else:
+            img = Image.open(os.path.join(self.root_dir, self.img_names[idx]))
         person_id = self.img_names[idx].split('_')[0]
         camera_id = self.img_names[idx].split('_')[1][1]
         
@@ -126,7 +164,7 @@ class Dataset_loader(torch.utils.data.Dataset):
 
 class Dataset_aligned_loader():
     
-    def __init__(self, root='', dataset_type='Train', transform=None): 
+    def __init__(self, root='', dataset_type='Train', transform=None, cache_dir=None, num_workers=0): 
 
         self.dataset_type = dataset_type
         self.datasets_loaders = []
@@ -135,7 +173,7 @@ class Dataset_aligned_loader():
         start_range_idx = 0
         start_range_class = 0
         for dataset_name in root:
-            dataset = Dataset_loader(dataset_name, dataset_type, transform)
+            dataset = Dataset_loader(dataset_name, dataset_type, transform, cache_dir=cache_dir, num_workers=num_workers)
             self.datasets_loaders.append(dataset)
             self.idx_ranges_to_dataset.append(range(start_range_idx, start_range_idx + len(dataset)))
             self.classes_ranges_to_dataset.append(range(start_range_class, start_range_class + dataset.total_ids))
@@ -144,6 +182,12 @@ class Dataset_aligned_loader():
 
         self.length = sum([len(dataset) for dataset in self.datasets_loaders])
         self.total_ids = sum([dataset.total_ids for dataset in self.datasets_loaders])
+
+        self.idx_starts = np.array([idx_range.start for idx_range in self.idx_ranges_to_dataset])
+        self.class_starts = np.array([classes_range.start for classes_range in self.classes_ranges_to_dataset])
+        self.image_classes = np.concatenate([dataset.image_classes + classes_range.start for dataset, classes_range
+                                             in zip(self.datasets_loaders, self.classes_ranges_to_dataset)])
+        self.class_images, self.class_offsets = get_class_index(self.image_classes, self.total_ids)
                              
             
     def __len__(self):
@@ -153,39 +197,26 @@ class Dataset_aligned_loader():
         return person_id + self.classes_ranges_to_dataset[dataset_idx].start
 
     def get_dataset_idx_and_class(self, person_id):
-        dataset_idx = -1
-        dataset_person_id = -1
-        for i, classes_range in enumerate(self.classes_ranges_to_dataset):
-            if person_id in classes_range:
-                dataset_idx = i
-                dataset_person_id = person_id - classes_range.start
-        return dataset_idx, dataset_person_id
+        if not 0 <= person_id < self.total_ids:
+            return -1, -1
+        dataset_idx = int(np.searchsorted(self.class_starts, person_id, side='right')) - 1
+        return dataset_idx, person_id - int(self.class_starts[dataset_idx])
+
+    def get_image_class(self, image_id):
+        return int(self.image_classes[image_id])
 
     def get_right_id_of_image(self, image_id, dataset_idx):
         return image_id + self.idx_ranges_to_dataset[dataset_idx].start
 
     def get_dataset_image_id(self, image_id):
-        dataset_idx = -1
-        dataset_image_id = -1
-        for i, idx_range in enumerate(self.idx_ranges_to_dataset):
-            if image_id in idx_range:
-                dataset_idx = i
-                dataset_image_id = image_id - idx_range.start
-        return dataset_idx, dataset_image_id
+        if not 0 <= image_id < self.length:
+            return -1, -1
+        dataset_idx = int(np.searchsorted(self.idx_starts, image_id, side='right')) - 1
+        return dataset_idx, image_id - int(self.idx_starts[dataset_idx])
 
     
     def get_random_class_image_idx(self, class_id, same_class):
-        if same_class:
-            dataset_idx, dataset_person_id = self.get_dataset_idx_and_class(class_id)
-            image_id = self.datasets_loaders[dataset_idx].get_random_class_image_idx(dataset_person_id, same_class)
-            return self.get_right_id_of_image(image_id, dataset_idx)
-        else:
-            an_class = torch.randint(0, self.total_ids, (1, )).item()
-            while an_class == class_id:
-                an_class = torch.randint(0, self.total_ids, (1, )).item()
-            dataset_idx, dataset_person_id = self.get_dataset_idx_and_class(an_class)
-            image_id = self.datasets_loaders[dataset_idx].get_random_class_image_idx(dataset_person_id, same_class)
-            return self.get_right_id_of_image(image_id, dataset_idx)
+        return get_random_class_image_idx(self.class_images, self.class_offsets, class_id, same_class)
     
     def __getitem__(self, idx):        
         dataset_idx, idx = self.get_dataset_image_id(idx)
@@ -193,17 +224,17 @@ class Dataset_aligned_loader():
         image['person_id'] = self.get_right_class_of_image(image['person_id'], dataset_idx)
         return image
 
-def get_train_dataset_loader(root):
+def get_train_dataset_loader(root, cache_dir=None, num_workers=0):
     if len(root) == 1:
-        train_dataset = Dataset_loader(root[0], "Train", get_transforms("Train"))
+        train_dataset = Dataset_loader(root[0], "Train", get_transforms("Train", cache_dir is not None), cache_dir=cache_dir, num_workers=num_workers)
     else :
-        train_dataset = Dataset_aligned_loader(root, "Train", get_transforms("Train"))
+        train_dataset = Dataset_aligned_loader(root, "Train", get_transforms("Train", cache_dir is not None), cache_dir, num_workers)
     return train_dataset
 
-def get_test_dataset_loader(root):
-    test_dataset = Dataset_loader(root, "Test", get_transforms("Test"))
+def get_test_dataset_loader(root, img_names=None, cache_dir=None, num_workers=0):
+    test_dataset = Dataset_loader(root, "Test", get_transforms("Test", cache_dir is not None), img_names, cache_dir, num_workers)
     return test_dataset
 
-def get_query_dataset_loader(root):
-    query_dataset = Dataset_loader(root, "Query", get_transforms("Query"))
+def get_query_dataset_loader(root, img_names=None, cache_dir=None, num_workers=0):
+    query_dataset = Dataset_loader(root, "Query", get_transforms("Query", cache_dir is not None), img_names, cache_dir, num_workers)
     return query_dataset
\ No newline at end of file
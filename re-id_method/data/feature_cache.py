@@ -0,0 +1,115 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+from util.descriptor_store import DescriptorStore, load_descriptor_store
+
+
+class Feature_loader(torch.utils.data.Dataset):
+    """Serves pre-extracted backbone features of a training dataset in place of its images
+
+    Features of augmentation draw d of image idx are row d * N + idx of the store and
+    every item picks a random draw. Items are 4096 x 1 x 1 tensors, so the model heads
+    take them as backbone outputs. The memory map is opened lazily like ImageCache.
+    """
+
+    def __init__(self, store_path, num_images, num_draws):
+        self.store_path = store_path
+        self.num_images = num_images
+        self.num_draws = num_draws
+        self._store = None
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = DescriptorStore.load(self.store_path)
+        return self._store
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_store'] = None
+        return state
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, idx):
+        row = torch.randint(0, self.num_draws, (1, )).item() * self.num_images + idx
+        features = torch.from_numpy(np.array(self.store.features[row], dtype = np.float32))
+        return {'image': features.view(-1, 1, 1), 'person_id': int(self.store.person_ids[row]),
+                'camera_id': int(self.store.camera_ids[row])}
+
+
+def get_train_mode_features(backbone_model, images):
+    """Backbone features of a batch as classifier pretraining computes them: train-mode BatchNorm under no_grad
+
+    BatchNorm normalizes with batch statistics; its running statistics are restored
+    afterwards, so the backbone is left unchanged.
+    """
+    buffers = [buffer.clone() for buffer in backbone_model.buffers()]
+    training = backbone_model.training
+    backbone_model.train()
+    with torch.no_grad():
+        features = backbone_model(images)
+        for buffer, saved in zip(backbone_model.buffers(), buffers):
+            buffer.copy_(saved)
+    backbone_model.train(training)
+    return features.reshape(features.size(0), -1)
+
+
+def extract_train_mode_features(backbone_model, dataset, batch_size = 32, num_workers = 0, device = 'cpu'):
+    """Returns (features, person ids, camera ids) of dataset in dataset order, extracted with get_train_mode_features
+
+    Images are fed in a random order, so that every batch mixes identities like
+    training batches do and the batch statistics match them.
+    """
+    order = torch.randperm(len(dataset)).numpy()
+    dataloader = DataLoader(Subset(dataset, order.tolist()), batch_size = batch_size, shuffle = False, num_workers = num_workers)
+    features = np.zeros((len(dataset), 4096), dtype = np.float32)
+    person_ids = np.zeros(len(dataset), dtype = np.int32)
+    camera_ids = np.zeros(len(dataset), dtype = np.int32)
+    start = 0
+    for batch in tqdm(dataloader):
+        rows = order[start:start + len(batch['image'])]
+        features[rows] = get_train_mode_features(backbone_model, batch['image'].to(device)).float().cpu().numpy()
+        person_ids[rows] = batch['person_id'].numpy()
+        camera_ids[rows] = batch['camera_id'].numpy()
+        start += len(rows)
+    return features, person_ids, camera_ids
+
+
+def check_feature_scale(store, dataset, backbone_model, batch_size = 32, device = 'cpu'):
+    """Returns the ratio of mean norms of live pretraining features and stored features of a random batch of images"""
+    idx = torch.randperm(len(dataset))[:batch_size].tolist()
+    images = torch.stack([dataset[i]['image'] for i in idx]).to(device)
+    live = get_train_mode_features(backbone_model, images).float().norm(dim = 1).mean().item()
+    stored = np.linalg.norm(np.asarray(store.features[idx], dtype = np.float32), axis = 1).mean()
+    return live / max(stored, 1e-12)
+
+
+def get_feature_loader(store_path, dataset, backbone_model, num_draws, header, batch_size = 32, num_workers = 0, device = 'cpu'):
+    """Returns a Feature_loader of dataset, extracting num_draws augmented passes unless a store with header exists
+
+    Features are extracted like the baseline pretraining computes them, with train-mode
+    BatchNorm under no_grad (see get_train_mode_features), one pass over the dataset at a
+    time, so memory use does not grow with num_draws. Stored features are then checked
+    against live ones, a scale mismatch means the heads would pretrain on a different
+    distribution than they are fine-tuned on.
+    """
+    header = dict(header, draws = num_draws, batchnorm = 'train', batch_size = batch_size)
+    store = load_descriptor_store(store_path, header)
+    if store is None or len(store) != num_draws * len(dataset):
+        for draw in range(num_draws):
+            print('Extracting pretraining features, draw {} of {}'.format(draw + 1, num_draws))
+            rows = DescriptorStore(*extract_train_mode_features(backbone_model, dataset, batch_size, num_workers, device), header = header)
+            if draw == 0:
+                rows.save(store_path)
+                store = DescriptorStore.load(store_path)
+            else:
+                store = store.append(store_path, rows)
+
+    ratio = check_feature_scale(store, dataset, backbone_model, batch_size, device)
+    print('Pretraining features: live / stored feature norm {:.3f}'.format(ratio))
+    if not 0.5 <= ratio <= 2.:
+        print('Warning: stored pretraining features do not match the features of fine-tuning, remove {} to extract them again'.format(store_path))
+    return Feature_loader(store_path, len(dataset), num_draws)
@@ -0,0 +1,108 @@
+import numpy as np
+import torch
+
+
+class RandomPairSampler(torch.utils.data.Sampler):
+    """Yields (first image index, second image index, verification) triples
+
+    The first image is drawn uniformly, the second one is an image of the same person
+    with probability positive_ratio and of another person otherwise.
+    """
+
+    def __init__(self, dataset, num_samples, positive_ratio=0.4):
+        self.dataset = dataset
+        self.num_samples = num_samples
+        self.positive_ratio = positive_ratio
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        for _ in range(self.num_samples):
+            k = torch.randint(0, len(self.dataset), (1,)).item()
+            same_class = torch.rand((1, )).item() <= self.positive_ratio
+            idx = self.dataset.get_random_class_image_idx(self.dataset.get_image_class(k), same_class)
+            yield k, idx, int(same_class)
+
+
+class Pair_dataset(torch.utils.data.Dataset):
+    """Loads both images of a (first, second, verification) triple from RandomPairSampler"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, pair):
+        first, second, verification = pair
+        first_image = self.dataset[first]
+        second_image = self.dataset[second]
+        return {'image_first': first_image['image'], 'person_id_first': first_image['person_id'], 'index_first': first,
+                'image_second': second_image['image'], 'person_id_second': second_image['person_id'], 'index_second': second,
+                'verification': verification}
+
+
+class PKBatchSampler(torch.utils.data.Sampler):
+    """Yields batches of num_instances images for each of num_identities random identities
+
+    Uses the flat class_images / class_offsets tables of the dataset, so drawing a batch
+    is a few vectorized indexing operations. Identities with fewer than num_instances
+    images repeat them.
+    """
+
+    def __init__(self, dataset, num_identities, num_instances, num_batches):
+        self.class_images = dataset.class_images
+        self.class_offsets = dataset.class_offsets
+        self.num_identities = min(num_identities, len(dataset.class_offsets) - 1)
+        self.num_instances = num_instances
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        counts = np.diff(self.class_offsets)
+        for _ in range(self.num_batches):
+            classes = torch.randperm(len(counts))[:self.num_identities].numpy()
+            class_counts = counts[classes]
+            keys = torch.rand((len(classes), max(class_counts.max(), self.num_instances))).numpy()
+            keys[np.arange(keys.shape[1])[None, :] >= class_counts[:, None]] = 2.
+            instances = np.argsort(keys, axis=1)[:, :self.num_instances] % class_counts[:, None]
+            yield self.class_images[self.class_offsets[classes][:, None] + instances].ravel().tolist()
+
+
+def get_batch_pairs(person_ids, num_instances, positive_ratio=0.4):
+    """Pairs every image of a PK batch with another image of the batch
+
+    With probability positive_ratio the partner is another instance of the same identity,
+    otherwise an instance of another identity. Returns partner indexes and verification labels.
+    """
+    batch_size = person_ids.size(0)
+    num_identities = batch_size // num_instances
+    rows = torch.arange(batch_size, device=person_ids.device)
+    identity, instance = rows // num_instances, rows % num_instances
+
+    positive = identity * num_instances + (instance + 1 + torch.randint(0, max(num_instances - 1, 1), (batch_size, ), device=person_ids.device)) % num_instances
+    negative_identity = (identity + 1 + torch.randint(0, max(num_identities - 1, 1), (batch_size, ), device=person_ids.device)) % num_identities
+    negative = negative_identity * num_instances + torch.randint(0, num_instances, (batch_size, ), device=person_ids.device)
+
+    partner = torch.where(torch.rand(batch_size, device=person_ids.device) <= positive_ratio, positive, negative)
+    return partner, (person_ids[partner] == person_ids).long()
+
+
+def get_hard_pairs(verification_logits, verification, hard_negative_ratio=1.):
+    """Selects all positive pairs and the hardest negatives among all pairs of a batch
+
+    Negatives are ranked by how confidently they are predicted as the same person, and
+    hard_negative_ratio negatives are kept per positive pair (all of them if it is not positive).
+    Returns a boolean mask over the pairs.
+    """
+    positive = verification == 1
+    if hard_negative_ratio <= 0:
+        return torch.ones_like(positive)
+    num_negatives = min(max(int(hard_negative_ratio * positive.sum().item()), 1), int((~positive).sum().item()))
+    scores = (verification_logits[:, 1] - verification_logits[:, 0]).detach().masked_fill(positive, -float('inf'))
+    selected = positive.clone()
+    selected[torch.topk(scores, num_negatives).indices] = True
+    return selected
@@ -0,0 +1,113 @@
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+MARS_FRAME = re.compile(r'^([-\d]+)C(\d+)T(\d+)F\d+')
+
+
+def parse_frame_name(name):
+    """Returns (person id, camera id, tracklet id or None) of a MARS <pid>C<cam>T<tracklet>F<frame> or Duke <pid>_c<cam>... frame name
+
+    MARS distractors (person folder 00-1) get person id -1.
+    """
+    match = MARS_FRAME.match(name)
+    if match is not None:
+        person_id = -1 if '-' in match.group(1) else int(match.group(1))
+        return person_id, int(match.group(2)), int(match.group(3))
+    return int(name.split('_')[0]), int(name.split('_')[1][1]), None
+
+
+def scan_tracklets(root_dir):
+    """Returns (tracklet names, lists of frame paths, person ids, camera ids) of a folder of tracklets
+
+    Frames named <pid>C<cam>T<tracklet>F<frame> (MARS <pid>/ folders) are grouped by their
+    folder, person, camera and tracklet. Otherwise every directory under root_dir holding
+    images is a tracklet (DukeMTMC-VideoReID <pid>/<tracklet>/ folders), and a flat Duke
+    style folder of images is split into tracklets by the <pid>_c<cam> prefix of its file
+    names. Person and camera ids are parsed from the name of the first frame.
+    """
+    tracklets = {}
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        dir_names.sort()
+        frames = sorted(name for name in file_names if name.lower().endswith(IMAGE_EXTENSIONS))
+        relative_dir = os.path.relpath(dir_path, root_dir)
+        for name in frames:
+            match = MARS_FRAME.match(name)
+            if match is not None:
+                key = os.path.normpath(os.path.join(relative_dir, '{}C{}T{}'.format(*match.groups()[:3])))
+            elif dir_path == root_dir:
+                key = '_'.join(name.split('_')[:2])
+            else:
+                key = relative_dir
+            tracklets.setdefault(key, []).append(os.path.join(dir_path, name))
+
+    names = sorted(tracklets)
+    frame_paths = [tracklets[name] for name in names]
+    first_frames = [parse_frame_name(os.path.basename(paths[0])) for paths in frame_paths]
+    person_ids = np.array([person_id for person_id, _, _ in first_frames], dtype = np.int32)
+    camera_ids = np.array([camera_id for _, camera_id, _ in first_frames], dtype = np.int32)
+    return names, frame_paths, person_ids, camera_ids
+
+
+def iterate_frame_batches(frame_paths, transform, batch_size = 64, queue_size = 4, num_workers = 4, max_frames = 0):
+    """Streams (images, tracklet indices) batches of the frames of all tracklets
+
+    A reader thread decodes frames with num_workers threads and puts batches into a
+    queue of at most queue_size batches, so decoding overlaps with the consumer and
+    memory stays bounded whatever the number of frames. Batches may mix frames of
+    consecutive tracklets. With max_frames > 0 only that many evenly spaced frames of
+    every tracklet are read.
+    """
+    def load_frame(path):
+        return transform(Image.open(path).convert('RGB'))
+
+    def get_frames():
+        for tracklet, paths in enumerate(frame_paths):
+            if max_frames > 0 and len(paths) > max_frames:
+                paths = [paths[i] for i in np.linspace(0, len(paths) - 1, max_frames).round().astype(int)]
+            for path in paths:
+                yield tracklet, path
+
+    batches = queue.Queue(maxsize = max(queue_size, 1))
+    stop = threading.Event()
+
+    def read():
+        try:
+            with ThreadPoolExecutor(max(num_workers, 1)) as pool:
+                chunk = []
+                for item in get_frames():
+                    chunk.append(item)
+                    if len(chunk) == batch_size:
+                        batches.put((torch.stack(list(pool.map(load_frame, [path for _, path in chunk]))), np.array([t for t, _ in chunk])))
+                        chunk = []
+                    if stop.is_set():
+                        return
+                if len(chunk) > 0:
+                    batches.put((torch.stack(list(pool.map(load_frame, [path for _, path in chunk]))), np.array([t for t, _ in chunk])))
+            batches.put(None)
+        except Exception as error:
+            batches.put(error)
+
+    reader = threading.Thread(target = read, daemon = True)
+    reader.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        while reader.is_alive():
+            try:
+                batches.get_nowait()
+            except queue.Empty:
+                reader.join(0.1)
@@ -0,0 +1,73 @@
+import os.path as osp
+import copy
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from models.res2net import Bottle2neck
+
+
+class QuantizableBottle2neck(Bottle2neck):
+    """Bottle2neck with a forward FX can trace and quantize: one torch.cat and no in-place writes"""
+
+    def forward(self, x):
+        residual = x
+
+        out = self.relu(self.bn1(self.conv1(x)))
+
+        spx = torch.split(out, self.width, 1)
+        sp = spx[0]
+        outs = []
+        for i, (conv, bn) in enumerate(zip(self.convs, self.bns)):
+            if i == 0 or self.stype == 'stage':
+                sp = spx[i]
+            else:
+                sp = sp + spx[i]
+            sp = self.relu(bn(conv(sp)))
+            outs.append(sp)
+        if self.scale != 1 and self.stype == 'normal':
+            outs.append(spx[self.nums])
+        elif self.scale != 1 and self.stype == 'stage':
+            outs.append(self.pool(spx[self.nums]))
+
+        out = self.bn3(self.conv3(torch.cat(outs, 1)))
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        return self.relu(out + residual)
+
+
+def get_quantizable_backbone(backbone):
+    """Returns an eval mode copy of a Res2Net backbone whose blocks are QuantizableBottle2neck"""
+    backbone = copy.deepcopy(backbone).cpu().eval()
+    for module in backbone.modules():
+        if type(module) is Bottle2neck:
+            module.__class__ = QuantizableBottle2neck
+    return backbone
+
+
+def quantize_backbone(backbone, calibration_loader, backend = 'x86'):
+    """Static int8 post-training quantization of a Res2Net backbone with FX graph mode
+
+    BatchNorms are fused into convolutions and activation ranges are calibrated on the
+    images of calibration_loader. The result takes and returns float tensors on CPU.
+    """
+    backbone = get_quantizable_backbone(backbone)
+    example = next(iter(calibration_loader))['image']
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(backend), example_inputs = (example, ))
+    with torch.no_grad():
+        for batch in calibration_loader:
+            prepared(batch['image'])
+    return convert_fx(prepared)
+
+
+def save_quantized_backbone(model, save_path, suffix = 'latest'):
+    """Saves a quantized backbone as TorchScript, so loading it needs no model code"""
+    torch.jit.save(torch.jit.script(model), osp.join(save_path, "backbone_int8_{}.pt".format(suffix)))
+
+
+def load_quantized_backbone(load_path, initial_suffix = 'latest'):
+    path = osp.join(load_path, "backbone_int8_{}.pt".format(initial_suffix))
+    if not osp.exists(path):
+        raise FileNotFoundError('{} does not exist, make it with python -m scripts.quantize_backbone'.format(path))
+    return torch.jit.load(path, map_location = 'cpu')
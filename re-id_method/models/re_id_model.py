@@ -1,53 +1,139 @@
 import torch.nn as nn
+import torch.nn.functional as F
 import os.path as osp
 import os
+import copy
 import torch
 from models.res2net import Res2Net
 from models.res2net import Bottle2neck
+from models.res2net import fold_batch_norms
 
 class ReIDModel(nn.Module):
-    """Basic neural network model for reidentification. Based on Res2Net"""
+    """Basic neural network model for reidentification. Based on Res2Net
+
+    With a positive embedding_dim the heads are factorized: the 1x1 convs project
+    4096-d features to embedding_dim and the linear layers map it to the outputs,
+    instead of two dense person_number-wide layers. With share_ident both
+    identification heads are the same modules.
+    """
     
-    def __init__(self, person_number):
+    def __init__(self, person_number, embedding_dim = 0, share_ident = False):
         super(ReIDModel, self).__init__()
+        self.embedding_dim = embedding_dim
+        self.share_ident = share_ident
 
         path = './models/res2net50_26w_4s-06e79181.pth'
         self.backbone = Res2Net(Bottle2neck, [3, 4, 6, 3], baseWidth = 26, scale = 4)
         self.backbone.load_state_dict(torch.load(path))
 
-        self.conv_ident1 = nn.Conv2d(4096, person_number, 1)
-        self.conv_ident2 = nn.Conv2d(4096, person_number, 1)
-        self.conv_verif = nn.Conv2d(4096, person_number, 1)
-        self.fc1 = nn.Linear(person_number, out_features=person_number)
-        self.fc2 = nn.Linear(person_number, out_features=person_number)
-        self.fc3 = nn.Linear(person_number, out_features=2)
+        self.refresh_number_of_labels(person_number)
+        self.features_input = False
+        self.sampled_classes = None
         
-    def forward(self, x, y, only_ident = False):
+    def forward(self, x, y, only_ident = False, shared = False, x_ids = None, y_ids = None):
+        """Returns verification logits and identification logits of both images of every pair
+
+        With shared the backbone runs once over x and y concatenated into one batch;
+        images with repeated ids (x_ids, y_ids, e.g. dataset indexes) go through it once.
+        """
+        if shared:
+            images = torch.cat((x, y))
+            if x_ids is not None and y_ids is not None:
+                ids, inverse = torch.unique(torch.cat((x_ids, y_ids)), return_inverse = True)
+                positions = torch.arange(inverse.size(0), device = inverse.device)
+                first = torch.full((ids.size(0), ), inverse.size(0), dtype = torch.long, device = inverse.device)
+                first = first.scatter_reduce(0, inverse, positions, reduce = 'amin')
+                return self.forward_indexed(images[first], inverse[:x.size(0)], inverse[x.size(0):], only_ident)
+            positions = torch.arange(images.size(0), device = images.device)
+            return self.forward_indexed(images, positions[:x.size(0)], positions[x.size(0):], only_ident)
+
+        return self.forward_heads(self.get_features(x, only_ident), self.get_features(y, only_ident))
+
+    def get_features(self, images, only_ident = False):
+        """Returns backbone features, or the input itself if features_input is set (pre-extracted features)"""
+        if self.features_input:
+            return images
         if only_ident:
             with torch.no_grad():
-                f1 = self.backbone(x)
-                f2 = self.backbone(y)
-        else:
-            f1 = self.backbone(x)
-            f2 = self.backbone(y)
-            
-        x = self.fc1(self.conv_ident1(f1).view(x.size(0), -1))
-        y = self.fc2(self.conv_ident2(f2).view(y.size(0), -1))
+                return self.backbone(images)
+        return self.backbone(images)
+
+    def forward_indexed(self, images, first_idx, second_idx, only_ident = False):
+        """Runs the backbone once over images and builds pairs (images[first_idx], images[second_idx])"""
+        features = self.get_features(images, only_ident)
+        return self.forward_heads(features[first_idx], features[second_idx])
+
+    def forward_all_pairs(self, images, only_ident = False):
+        """Returns verification logits of all B * (B - 1) / 2 pairs of a batch with their indexes
+
+        Pairs of an image with itself are left out, and each unordered pair appears once
+        since the squared difference is symmetric. Both identification heads see every image.
+        """
+        features = self.get_features(images, only_ident)
+        first, second = torch.triu_indices(images.size(0), images.size(0), 1, device = images.device)
+        z = (features[first] - features[second]) ** 2
+        z = self.fc3(self.conv_verif(z).view(z.size(0), -1))
+        x = self.identify(self.fc1, self.conv_ident1(features).view(features.size(0), -1))
+        y = self.identify(self.fc2, self.conv_ident2(features).view(features.size(0), -1))
+        return z, x, y, first, second
+
+    def forward_heads(self, f1, f2):
+        x = self.identify(self.fc1, self.conv_ident1(f1).view(f1.size(0), -1))
+        y = self.identify(self.fc2, self.conv_ident2(f2).view(f2.size(0), -1))
         z = (f1 - f2) ** 2
         z = self.fc3(self.conv_verif(z).view(z.size(0), -1))    
         return z, x, y
 
+    def sample_classes(self, person_ids, num_classes):
+        """Restricts identification logits to the classes of person_ids plus random other classes
+
+        Draws num_classes classes in total (fewer if random ones repeat) and returns person_ids
+        mapped to their positions among them. Only the sampled rows of fc1 / fc2 are read,
+        and their weights get sparse gradients. With num_classes <= 0 full logits are restored.
+        """
+        if num_classes <= 0:
+            self.sampled_classes = None
+            return person_ids
+        classes = torch.unique(person_ids)
+        negatives = torch.randint(0, self.fc1.out_features, (max(num_classes - classes.size(0), 0), ), device = person_ids.device)
+        self.sampled_classes = torch.unique(torch.cat((classes, negatives)))
+        return self.get_sampled_targets(person_ids)
+
+    def get_sampled_targets(self, person_ids):
+        """Maps person ids to positions among the sampled classes"""
+        if self.sampled_classes is None:
+            return person_ids
+        return torch.searchsorted(self.sampled_classes, person_ids)
+
+    def identify(self, fc, h):
+        if self.sampled_classes is None:
+            return fc(h)
+        weight = F.embedding(self.sampled_classes, fc.weight, sparse = True)
+        return F.linear(h, weight, fc.bias[self.sampled_classes])
+
     def refresh_number_of_labels(self, person_number):
-        self.conv_ident1 = nn.Conv2d(4096, person_number, 1)
-        self.conv_ident2 = nn.Conv2d(4096, person_number, 1)
-        self.conv_verif = nn.Conv2d(4096, person_number, 1)
-        self.fc1 = nn.Linear(person_number, out_features=person_number)
-        self.fc2 = nn.Linear(person_number, out_features=person_number)
-        self.fc3 = nn.Linear(person_number, out_features=2)
+        hidden = self.embedding_dim if self.embedding_dim > 0 else person_number
+        self.conv_ident1 = nn.Conv2d(4096, hidden, 1)
+        self.conv_verif = nn.Conv2d(4096, hidden, 1)
+        self.fc1 = nn.Linear(hidden, out_features=person_number)
+        self.fc3 = nn.Linear(hidden, out_features=2)
+        if self.share_ident:
+            self.conv_ident2 = self.conv_ident1
+            self.fc2 = self.fc1
+        else:
+            self.conv_ident2 = nn.Conv2d(4096, hidden, 1)
+            self.fc2 = nn.Linear(hidden, out_features=person_number)
 
     def get_backbone_model(self):
         return self.backbone
 
+    def export_backbone(self):
+        """Returns an eval-only copy of the backbone with every BatchNorm folded into its convolution"""
+        return fold_batch_norms(copy.deepcopy(self.backbone))
+
+    def save_exported_backbone(self, save_path, suffix = "latest"):
+        torch.save(self.export_backbone().state_dict(), osp.join(save_path, "backbone_folded_{}.pth".format(suffix)))
+
     def save_model(self, save_path, suffix = "latest"):
         torch.save(self.backbone.state_dict(), osp.join(save_path, "backbone_{}.pth".format(suffix)))
 
@@ -71,10 +157,29 @@ class ReIDModel(nn.Module):
 
 
             
-def get_model(num_of_labels, load_path = None, initial_suffix = 'latest', only_backbone = False, device = None):
-    model = ReIDModel(num_of_labels)
+def get_model(num_of_labels, load_path = None, initial_suffix = 'latest', only_backbone = False, device = None, embedding_dim = 0, share_ident = False):
+    model = ReIDModel(num_of_labels, embedding_dim, share_ident)
     if load_path is not None:
         model.load_model(load_path, only_backbone, initial_suffix)
     if device is not None:
         model = model.to(device)
-    return model
\ No newline at end of file
+    return model
+
+
+def get_folded_backbone(load_path, initial_suffix = 'latest', device = None):
+    """Loads the BatchNorm-folded backbone of a checkpoint, exporting and saving it first if needed
+
+    The folded backbone is exported again whenever backbone_<suffix>.pth is newer than it
+    (e.g. train.py overwrote backbone_latest.pth); a folded file without its source is
+    loaded as is. Only the backbone is built, so the ImageNet weights and the heads are
+    not loaded.
+    """
+    path = osp.join(load_path, "backbone_folded_{}.pth".format(initial_suffix))
+    source = osp.join(load_path, "backbone_{}.pth".format(initial_suffix))
+    if not osp.exists(path) or (osp.exists(source) and os.stat(source).st_mtime_ns > os.stat(path).st_mtime_ns):
+        get_model(1, load_path, initial_suffix, True).save_exported_backbone(load_path, initial_suffix)
+    backbone = fold_batch_norms(Res2Net(Bottle2neck, [3, 4, 6, 3], baseWidth = 26, scale = 4))
+    backbone.load_state_dict(torch.load(path))
+    if device is not None:
+        backbone = backbone.to(device)
+    return backbone
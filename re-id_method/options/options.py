@@ -11,11 +11,17 @@ class Options():
             parser.add_argument('--nepochs', type = int, default = 256, help = '# of epochs')
             parser.add_argument('--start_epoch', type = int, default = 1, help = '# of start epoch')
             parser.add_argument('--batch_size', type = int, default = 16, help = 'Batch size')
+            parser.add_argument('--num_workers', type = int, default = 4, help = 'Number of DataLoader workers')
+            parser.add_argument('--shared_forward', action = 'store_true', help = 'Run the backbone once per batch over both images of all pairs, skipping repeated images')
+            parser.add_argument('--num_instances', type = int, default = 0, help = 'If positive, sample batches of batch_size / num_instances identities with num_instances images each (at least 2) and pair images inside a batch')
+            parser.add_argument('--all_pairs', action = 'store_true', help = 'With num_instances, train verification on all pairs of a batch instead of one pair per image')
+            parser.add_argument('--hard_negative_ratio', type = float, default = 1., help = 'With all_pairs, number of hardest negative pairs kept per positive pair, all negatives if not positive')
             parser.add_argument('--lr', type = float, default = 0.05, help = 'Initial learning rate for SGD optimizer')
             parser.add_argument('--warmup_epoch', type = int, default = 0, help = 'Epochs to GradualWarmupScheduler')
             parser.add_argument('--start_step_lr', type = int, default = 40, help = 'Epoch from which reduce lr')
 
             parser.add_argument('--dataroot', type = str, action = 'append', required = True, help = 'list of paths to images root(Duke style)')
+            parser.add_argument('--cache_dir', type = str, default = None, help = 'Directory for pre-decoded image caches, not used if not specified')
             parser.add_argument('--gpu_id', type = int, default = 0, help = 'Specify gpu ids if -1 than CPU')
             parser.add_argument('--name', type = str, required = True, help = 'Name of the experiment')
             parser.add_argument('--save_suffix', type = str, default = '', help = 'Suffix to save results')
@@ -23,7 +29,11 @@ class Options():
             parser.add_argument('--only_backbone', action = 'store_true', help = 'Need if load only backbone weights (for finetuning on another number of person_id)')
             parser.add_argument('--initial_weights', type = str, help = 'Initialization weights experiment name')
             parser.add_argument('--initial_suffix', type = str, default = 'latest', help = 'Intital suffix')
+            parser.add_argument('--embedding_dim', type = int, default = 0, help = 'If positive, factorize the classifier heads through an embedding of this size')
+            parser.add_argument('--sampled_classes', type = int, default = 0, help = 'If positive, compute identification logits only for batch identities plus random others, this many in total')
+            parser.add_argument('--share_ident', action = 'store_true', help = 'Share weights between the two identification heads')
             parser.add_argument('--pretrain_classifiers_epochs', type=int, default = 0, help = 'Steps to pretrain classifiers')
+            parser.add_argument('--pretrain_feature_draws', type = int, default = 0, help = 'If positive, extract backbone features of this many augmented passes once and pretrain classifiers on them')
             parser.add_argument('--pretrain_classifiers_lr', type=int, default = 0.05, help = 'Steps to pretrain classifiers')
 
             parser.add_argument('--checkpoint_every', type = int, default = 1000, help = 'Number of epochs to make checkpoint')
@@ -32,6 +42,8 @@ class Options():
 
 
             self.opt = parser.parse_args()
+            if self.opt.num_instances > 0 and not 2 <= self.opt.num_instances <= self.opt.batch_size:
+                parser.error('--num_instances must be between 2 and --batch_size ({}), got {}'.format(self.opt.batch_size, self.opt.num_instances))
 
             self.opt.save_weights_path = osp.join("./checkpoints", self.opt.name)
 
@@ -48,14 +60,34 @@ class Options():
             parser = argparse.ArgumentParser(description = "Test options")
 
             parser.add_argument('--dataroot', type = str, action = 'store', required = True, help = 'path to images root(Duke style)')
+            parser.add_argument('--cache_dir', type = str, default = None, help = 'Directory for pre-decoded image caches, not used if not specified')
             parser.add_argument('--gpu_id', type = int, default = 0, help = 'Specify gpu ids if -1 than CPU')
 
             parser.add_argument('--name', type = str, required = True, help = 'Name of the experiment to load')
 
             parser.add_argument('--initial_suffix', type = str, default = 'latest', help = 'Intital suffix')
             parser.add_argument('--batch_size', type = int, default = 32, help = 'Batch size of testing')
-            parser.add_argument('--no_load', action = 'store_true', help = 'Specify if not to use stored computations')
+            parser.add_argument('--num_workers', type = int, default = 4, help = 'Number of DataLoader workers for descriptor extraction')
+            parser.add_argument('--no_load', action = 'store_true', help = 'Specify if not to use stored computations (re-embeds every query and gallery image)')
             parser.add_argument('--save_suffix', type = str, default = '', help = 'Suffix to save results')
+            parser.add_argument('--descriptor_dtype', type = str, default = 'float32', choices = ['float32', 'float16'], help = 'Dtype of stored query and gallery descriptors')
+            parser.add_argument('--fold_bn', action = 'store_true', help = 'Use the backbone with BatchNorms folded into convolutions (exported to backbone_folded_<suffix>.pth on first use)')
+            parser.add_argument('--no_projection', action = 'store_true', help = 'Do not apply the PCA projection saved with the checkpoint (projection_<suffix>.npz)')
+            parser.add_argument('--int8', action = 'store_true', help = 'Use the int8 backbone made by scripts.quantize_backbone (CPU only)')
+            parser.add_argument('--channels_last', action = 'store_true', help = 'Run the backbone in channels_last memory format')
+            parser.add_argument('--bf16', action = 'store_true', help = 'Run the backbone under bfloat16 autocast')
+            parser.add_argument('--tta_flip', action = 'store_true', help = 'Average descriptors of the image and its horizontal flip, computed in one forward pass')
+            parser.add_argument('--tta_scales', type = float, nargs = '+', default = [], help = 'Also average descriptors of centered crops keeping these fractions of the image, resized back to 256x128 (each view multiplies the backbone batch)')
+            parser.add_argument('--market_protocol', action = 'store_true', help = 'Discard only same person same camera gallery images instead of every same camera image')
+            parser.add_argument('--top_k', type = int, default = 0, help = 'If positive, keep and save only top-k gallery matches per query (int32 indices, float16 scores)')
+            parser.add_argument('--memory_budget', type = int, default = 256, help = 'Memory budget in MB for one tile of query-gallery similarities')
+            parser.add_argument('--qe_k', type = int, default = 0, help = 'If positive, expand every query with its top-k gallery matches (alpha query expansion)')
+            parser.add_argument('--dba_k', type = int, default = 0, help = 'If positive, replace every gallery descriptor with the weighted sum of its top-k gallery neighbors (database-side augmentation)')
+            parser.add_argument('--expansion_alpha', type = float, default = 3., help = 'Neighbors of query expansion and database-side augmentation are weighted by similarity ** alpha, 0 for the plain average')
+            parser.add_argument('--rerank', action = 'store_true', help = 'Also evaluate k-reciprocal re-ranking and report its latency and gain')
+            parser.add_argument('--k1', type = int, default = 20, help = 'Re-ranking: number of k-reciprocal neighbors')
+            parser.add_argument('--k2', type = int, default = 6, help = 'Re-ranking: number of neighbors averaged in local query expansion')
+            parser.add_argument('--rerank_lambda', type = float, default = 0.3, help = 'Re-ranking: weight of the original distance in the final distance')
 
             self.opt = parser.parse_args()
 
@@ -68,6 +100,9 @@ class Options():
             self.opt.only_backbone = True
 
             self.opt.device = torch.device(self.opt.gpu_id) if (torch.cuda.is_available() and self.opt.gpu_id >= 0) else torch.device("cpu")
+            if self.opt.int8:
+                # quantized kernels run on CPU only
+                self.opt.device = torch.device("cpu")
 
 
             
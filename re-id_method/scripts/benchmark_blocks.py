@@ -0,0 +1,122 @@
+"""Benchmarks Bottle2neck.forward against the torch.cat based implementation it replaced.
+
+Builds the first ('stage') and a following ('normal') block of every Res2Net-50
+layer, checks that the buffered forward gives the same outputs and input gradients
+as the legacy one, and reports the median time of a forward pass of the legacy
+block, the buffered block and its TorchScript version (and torch.compile with
+--compile). Legacy and buffered passes are timed alternately in --num_repeats rounds
+and the spread of their speed ratios is reported, as single runs are dominated by
+noise; blocks where the buffered forward is slower are flagged.
+
+The buffered forward is not faster everywhere. On a 1 core CPU at batch size 32 two
+runs gave 0.93-1.10x on the 'stage' blocks, 0.95-1.17x on the 'normal' blocks and
+0.95-1.03x on layer4 (planes 512), with the sign flipping between runs for most
+blocks: the saved torch.cat copies are within noise of the convolutions on CPU.
+
+Run from re-id_method, e.g.
+    python -m scripts.benchmark_blocks --batch_size 32 --channels_last
+"""
+import argparse
+from time import time
+import torch
+from models.res2net import Bottle2neck
+
+# (inplanes, planes, stride, input height, input width) of the blocks for 256 x 128 images
+LAYERS = [(64, 64, 1, 64, 32), (256, 128, 2, 64, 32), (512, 256, 2, 32, 16), (1024, 512, 2, 16, 8)]
+
+
+def legacy_forward(block, x):
+    """Bottle2neck.forward before the preallocated buffer"""
+    residual = x
+    out = block.relu(block.bn1(block.conv1(x)))
+    spx = torch.split(out, block.width, 1)
+    for i in range(block.nums):
+        if i == 0 or block.stype == 'stage':
+            sp = spx[i]
+        else:
+            sp = sp + spx[i]
+        sp = block.relu(block.bns[i](block.convs[i](sp)))
+        out = sp if i == 0 else torch.cat((out, sp), 1)
+    if block.scale != 1 and block.stype == 'normal':
+        out = torch.cat((out, spx[block.nums]), 1)
+    elif block.scale != 1 and block.stype == 'stage':
+        out = torch.cat((out, block.pool(spx[block.nums])), 1)
+    out = block.bn3(block.conv3(out))
+    if block.downsample is not None:
+        residual = block.downsample(x)
+    out += residual
+    return block.relu(out)
+
+
+def make_blocks(inplanes, planes, stride):
+    downsample = torch.nn.Sequential(torch.nn.Conv2d(inplanes, planes * 4, kernel_size=1, stride=stride, bias=False),
+                                     torch.nn.BatchNorm2d(planes * 4))
+    return [('stage', Bottle2neck(inplanes, planes, stride, downsample=downsample, stype='stage'), inplanes),
+            ('normal', Bottle2neck(planes * 4, planes), planes * 4)]
+
+
+def time_forward(forward, x, num_runs):
+    """Returns the median time of a forward pass in ms"""
+    times = []
+    with torch.no_grad():
+        forward(x)
+        forward(x)
+        for _ in range(num_runs):
+            start = time()
+            forward(x)
+            times.append(time() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def time_ratios(legacy, buffered, x, num_runs, num_repeats):
+    """Returns (median legacy ms, median buffered ms, sorted legacy / buffered ratios of the rounds)"""
+    rounds = [(time_forward(legacy, x, num_runs), time_forward(buffered, x, num_runs)) for _ in range(num_repeats)]
+    legacy_times = sorted(legacy_time for legacy_time, _ in rounds)
+    buffered_times = sorted(buffered_time for _, buffered_time in rounds)
+    ratios = sorted(legacy_time / buffered_time for legacy_time, buffered_time in rounds)
+    return legacy_times[num_repeats // 2], buffered_times[num_repeats // 2], ratios
+
+
+def check_gradients(block, x):
+    x = x.clone().requires_grad_(True)
+    block.train()
+    legacy_forward(block, x).sum().backward()
+    legacy_grad = x.grad.clone()
+    x.grad = None
+    block(x).sum().backward()
+    block.eval()
+    return (x.grad - legacy_grad).abs().max().item() / legacy_grad.abs().max().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Bottle2neck benchmark")
+    parser.add_argument('--batch_size', type = int, default = 32, help = 'Batch size')
+    parser.add_argument('--num_runs', type = int, default = 10, help = 'Number of timed forward passes')
+    parser.add_argument('--num_repeats', type = int, default = 3, help = 'Number of alternating legacy / buffered timing rounds')
+    parser.add_argument('--channels_last', action = 'store_true', help = 'Run blocks in channels_last memory format')
+    parser.add_argument('--compile', action = 'store_true', help = 'Also time torch.compile of the buffered block')
+    opt = parser.parse_args()
+    memory_format = torch.channels_last if opt.channels_last else torch.contiguous_format
+
+    slower = []
+    for inplanes, planes, stride, height, width in LAYERS:
+        for stype, block, block_inplanes in make_blocks(inplanes, planes, stride):
+            block = block.eval().to(memory_format = memory_format)
+            h, w = (height, width) if stype == 'stage' else (height // stride, width // stride)
+            x = torch.randn(opt.batch_size, block_inplanes, h, w).to(memory_format = memory_format)
+
+            with torch.no_grad():
+                max_diff = (block(x) - legacy_forward(block, x)).abs().max().item()
+            grad_diff = check_gradients(block, x[:2])
+            legacy, buffered, ratios = time_ratios(lambda x: legacy_forward(block, x), block, x, opt.num_runs, opt.num_repeats)
+            ratio = ratios[len(ratios) // 2]
+            if ratio < 1:
+                slower.append('planes {} {} ({:.2f}x)'.format(planes, stype, ratio))
+            scripted = time_forward(torch.jit.script(block), x, opt.num_runs)
+            line = 'planes {:3d} {:6s}: legacy {:7.2f} ms, buffered {:7.2f} ms ({:.2f}x, {:.2f}-{:.2f}x){}, scripted {:7.2f} ms'.format(
+                planes, stype, legacy, buffered, ratio, ratios[0], ratios[-1], ' SLOWER' if ratio < 1 else '', scripted)
+            if opt.compile:
+                line += ', compiled {:7.2f} ms'.format(time_forward(torch.compile(block), x, opt.num_runs))
+            print(line + ', max output difference {:.1e}, relative gradient difference {:.1e}'.format(max_diff, grad_diff))
+    print('Buffered forward slower than legacy on {} of {} blocks{}'.format(len(slower), 2 * len(LAYERS),
+                                                                          ': ' + ', '.join(slower) if slower else ''))
@@ -0,0 +1,64 @@
+"""Benchmarks dense and factorized ReIDModel heads.
+
+Runs SGD steps of the heads alone on random 4096-d backbone features (the backbone
+is skipped through features_input) and reports parameter count, memory of head
+parameters with their gradients and momentum, and time per step, for every number
+of identities and head configuration.
+
+Run from re-id_method, e.g.
+    python -m scripts.benchmark_heads --num_ids 702 4000 16000 --embedding_dim 512
+"""
+import argparse
+from time import time
+import torch
+import torch.nn.functional as F
+from models.re_id_model import get_model
+
+
+def benchmark_heads(model, num_ids, batch_size, num_steps, device):
+    model.features_input = True
+    heads = [p for name, p in model.named_parameters() if not name.startswith('backbone.')]
+    optimizer = torch.optim.SGD(heads, lr = 0.01, momentum = 0.9)
+    features = torch.rand(batch_size, 4096, 1, 1, device = device)
+    ids = torch.randint(0, num_ids, (batch_size, ), device = device)
+    verification = torch.randint(0, 2, (batch_size, ), device = device)
+
+    def step():
+        optimizer.zero_grad()
+        z, x, y = model.forward_indexed(features, torch.arange(batch_size, device = device), torch.randperm(batch_size, device = device))
+        loss = F.cross_entropy(z, verification) + 0.5 * (F.cross_entropy(x, ids) + F.cross_entropy(y, ids))
+        loss.backward()
+        optimizer.step()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time()
+    for _ in range(num_steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    num_params = sum(p.numel() for p in heads)
+    # parameters, gradients and momentum buffers
+    memory = 3 * sum(p.numel() * p.element_size() for p in heads)
+    return num_params, memory, (time() - start) * 1000 / num_steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Classifier heads benchmark")
+    parser.add_argument('--num_ids', type = int, nargs = '+', default = [702, 4000, 16000], help = 'Numbers of identities to benchmark')
+    parser.add_argument('--embedding_dim', type = int, default = 512, help = 'Embedding size of factorized heads')
+    parser.add_argument('--batch_size', type = int, default = 16, help = 'Batch size')
+    parser.add_argument('--num_steps', type = int, default = 20, help = 'Number of timed steps')
+    parser.add_argument('--gpu_id', type = int, default = -1, help = 'Specify gpu ids if -1 than CPU')
+    opt = parser.parse_args()
+    device = torch.device(opt.gpu_id) if (torch.cuda.is_available() and opt.gpu_id >= 0) else torch.device("cpu")
+
+    configs = [('dense', 0, False), ('factorized', opt.embedding_dim, False), ('factorized shared', opt.embedding_dim, True)]
+    for num_ids in opt.num_ids:
+        for name, embedding_dim, share_ident in configs:
+            model = get_model(num_ids, device = device, embedding_dim = embedding_dim, share_ident = share_ident)
+            num_params, memory, step_time = benchmark_heads(model, num_ids, opt.batch_size, opt.num_steps, device)
+            print('{:6d} ids, {:18s}: {:7.2f} M head parameters, {:8.1f} MB with gradients and momentum, {:8.2f} ms/step'
+                  .format(num_ids, name, num_params / 1e6, memory / 2 ** 20, step_time))
+            del model
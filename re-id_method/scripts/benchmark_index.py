@@ -0,0 +1,73 @@
+"""Benchmarks approximate gallery indices against exact search.
+
+Reports recall@k of the approximate top-k against the exact top-k and the search
+latency per query for a range of nprobe values. Descriptors come from the stores
+written by test.py or are generated synthetically.
+
+Run from re-id_method, e.g.
+    python -m scripts.benchmark_index --name DukeMTMC --nlist 256 --nprobe 1 4 16 64
+    python -m scripts.benchmark_index --synthetic 200000 --pq_m 64
+"""
+import argparse
+import os.path as osp
+from time import time
+import numpy as np
+from util.descriptor_store import DescriptorStore
+from util.gallery_index import get_gallery_index
+
+
+def make_synthetic_descriptors(num_gallery, num_query, dim, num_ids, seed = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size = (num_ids, dim)).astype(np.float32)
+    gallery = centers[rng.integers(0, num_ids, num_gallery)] + rng.normal(size = (num_gallery, dim)).astype(np.float32)
+    query = centers[rng.integers(0, num_ids, num_query)] + rng.normal(size = (num_query, dim)).astype(np.float32)
+    return query, gallery
+
+
+def recall_at_k(found_ids, exact_ids):
+    hits = (found_ids[:, :, None] == exact_ids[:, None, :]).any(2).sum(1)
+    return (hits / exact_ids.shape[1]).mean()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Gallery index benchmark")
+    parser.add_argument('--name', type = str, help = 'Experiment whose testing_results descriptor stores are used')
+    parser.add_argument('--suffix', type = str, default = 'latest', help = 'Suffix of the descriptor stores')
+    parser.add_argument('--synthetic', type = int, default = 0, help = 'Number of synthetic gallery descriptors used instead of stores')
+    parser.add_argument('--num_query', type = int, default = 1000, help = 'Number of synthetic queries')
+    parser.add_argument('--dim', type = int, default = 4096, help = 'Dimension of synthetic descriptors')
+    parser.add_argument('--k', type = int, default = 10, help = 'Recall@k')
+    parser.add_argument('--nlist', type = int, default = 256, help = 'Number of inverted lists')
+    parser.add_argument('--nprobe', type = int, nargs = '+', default = [1, 4, 16, 64], help = 'Numbers of probed lists to evaluate')
+    parser.add_argument('--pq_m', type = int, default = 0, help = 'Bytes per product-quantized descriptor, 0 for no PQ')
+    parser.add_argument('--save_index', type = str, default = '', help = 'Path to save the built IVF index')
+    opt = parser.parse_args()
+
+    if opt.synthetic > 0:
+        query, gallery = make_synthetic_descriptors(opt.synthetic, opt.num_query, opt.dim, max(opt.synthetic // 20, 1))
+    else:
+        results_path = osp.join("./checkpoints", opt.name, "testing_results")
+        query = DescriptorStore.load(osp.join(results_path, 'query_descriptors_{}'.format(opt.suffix))).features
+        gallery = DescriptorStore.load(osp.join(results_path, 'gallery_descriptors_{}'.format(opt.suffix))).features
+    print('Gallery {} x {}, {} queries'.format(gallery.shape[0], gallery.shape[1], len(query)))
+
+    exact = get_gallery_index('flat', gallery.shape[1])
+    exact.add(gallery)
+    start = time()
+    _, exact_ids = exact.search(query, opt.k)
+    print('Exact search: {:.3f} ms/query'.format((time() - start) * 1000 / len(query)))
+
+    index = get_gallery_index('ivf', gallery.shape[1], nlist = opt.nlist, pq_m = opt.pq_m)
+    start = time()
+    index.train(gallery)
+    index.add(gallery)
+    print('IVF{}{} build: {:.1f} s'.format(opt.nlist, ',PQ{}'.format(opt.pq_m) if opt.pq_m > 0 else '', time() - start))
+    if opt.save_index != '':
+        index.save(opt.save_index)
+
+    for nprobe in opt.nprobe:
+        start = time()
+        _, found_ids = index.search(query, opt.k, nprobe)
+        elapsed = time() - start
+        print('nprobe {:4d}: recall@{} {:.4f}, {:.3f} ms/query'.format(nprobe, opt.k, recall_at_k(found_ids, exact_ids),
+                                                                        elapsed * 1000 / len(query)))
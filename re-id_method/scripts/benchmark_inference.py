@@ -0,0 +1,95 @@
+"""Benchmarks backbone inference modes against the float32 NCHW descriptor extractor.
+
+For every mode reports CPU (or GPU) throughput in images/s and how far its
+descriptors are from float32 ones: the largest absolute difference relative to the
+descriptor norm and the smallest cosine similarity. A mode fails the check if the
+smallest cosine similarity is below --tolerance. Images are gallery images of --dataroot or are
+random; they are decoded once before timing.
+
+Run from re-id_method, e.g.
+    python -m scripts.benchmark_inference --name DukeMTMC --dataroot ../DukeMTMC-reID
+    python -m scripts.benchmark_inference --modes fp32 channels_last bf16 folded
+"""
+import argparse
+import copy
+import sys
+from time import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from data.dataset import get_test_dataset_loader
+from models.re_id_model import get_model
+from models.res2net import fold_batch_norms
+from util.extraction import extract_descriptors, prepare_inference_model
+
+
+class Tensor_loader(TensorDataset):
+    """Wraps an image tensor into the dict items of the dataset loaders"""
+
+    def __getitem__(self, idx):
+        return {'image': self.tensors[0][idx], 'person_id': 0, 'camera_id': 0}
+
+
+def get_modes():
+    """Maps mode names to (function making an inference model from the backbone, channels_last, bf16)"""
+    return {'fp32': (lambda backbone: prepare_inference_model(backbone), False, False),
+            'channels_last': (lambda backbone: prepare_inference_model(backbone, True), True, False),
+            'bf16': (lambda backbone: prepare_inference_model(backbone, True), True, True),
+            'folded': (lambda backbone: prepare_inference_model(fold_batch_norms(backbone), True), True, False),
+            'folded_bf16': (lambda backbone: prepare_inference_model(fold_batch_norms(backbone), True), True, True),
+            'scripted': (lambda backbone: torch.jit.freeze(torch.jit.script(prepare_inference_model(fold_batch_norms(backbone), True))), True, False)}
+
+
+def compare_descriptors(features, reference):
+    norms = np.linalg.norm(reference, axis = 1)
+    max_diff = (np.abs(features - reference).max(1) / norms).max()
+    cosine = (features * reference).sum(1) / (np.linalg.norm(features, axis = 1) * norms)
+    return max_diff, cosine.min()
+
+
+if __name__ == "__main__":
+    modes = get_modes()
+    parser = argparse.ArgumentParser(description = "Backbone inference benchmark")
+    parser.add_argument('--name', type = str, default = None, help = 'Experiment to load the backbone from, ImageNet weights if not specified')
+    parser.add_argument('--suffix', type = str, default = 'latest', help = 'Suffix of the backbone checkpoint')
+    parser.add_argument('--dataroot', type = str, default = None, help = 'Path to images root(Duke style), gallery images are used; random images if not specified')
+    parser.add_argument('--num_images', type = int, default = 256, help = 'Number of benchmarked images')
+    parser.add_argument('--batch_size', type = int, default = 32, help = 'Batch size')
+    parser.add_argument('--modes', type = str, nargs = '+', default = list(modes), choices = list(modes), help = 'Inference modes to benchmark')
+    parser.add_argument('--tolerance', type = float, default = 0.999, help = 'Smallest allowed cosine similarity to float32 descriptors')
+    parser.add_argument('--num_threads', type = int, default = 0, help = 'Number of CPU threads, torch default if 0')
+    parser.add_argument('--gpu_id', type = int, default = -1, help = 'Specify gpu ids if -1 than CPU')
+    opt = parser.parse_args()
+    device = torch.device(opt.gpu_id) if (torch.cuda.is_available() and opt.gpu_id >= 0) else torch.device("cpu")
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+
+    # decode once so that the timings measure the backbone only
+    if opt.dataroot is not None:
+        dataset = get_test_dataset_loader(opt.dataroot)
+        images = torch.stack([dataset[i]['image'] for i in range(min(opt.num_images, len(dataset)))])
+    else:
+        images = torch.randn(opt.num_images, 3, 256, 128)
+    dataloader = DataLoader(Tensor_loader(images), batch_size = opt.batch_size, shuffle = False)
+    warmup_loader = DataLoader(Tensor_loader(images[:opt.batch_size]), batch_size = opt.batch_size)
+
+    backbone = get_model(1, None if opt.name is None else './checkpoints/{}'.format(opt.name), opt.suffix, True).get_backbone_model()
+    reference = None
+    failed = False
+    for name in ['fp32'] + [mode for mode in opt.modes if mode != 'fp32']:
+        make_model, channels_last, bf16 = modes[name]
+        model = make_model(copy.deepcopy(backbone)).to(device)
+        extract_descriptors(model, warmup_loader, device, channels_last, bf16)
+        start = time()
+        features, _, _ = extract_descriptors(model, dataloader, device, channels_last, bf16)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        images_per_second = len(features) / (time() - start)
+
+        if reference is None:
+            reference = features
+        max_diff, min_cosine = compare_descriptors(features, reference)
+        failed = failed or min_cosine < opt.tolerance
+        print('{:14s}: {:8.1f} images/s, max relative difference {:.2e}, min cosine similarity {:.6f}{}'
+              .format(name, images_per_second, max_diff, min_cosine, '' if min_cosine >= opt.tolerance else '  FAIL'))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,88 @@
+"""Checks util.metrics against the per-query rank-1 / mAP loops test.py used before
+and the streaming top-k ranking of util.ranking against util.metrics.
+
+Run from re-id_method: python -m scripts.check_metrics
+"""
+import argparse
+import numpy as np
+from sklearn.metrics import average_precision_score
+from util.metrics import evaluate
+from util.ranking import topk_ranking
+from util.similarity import cosine_similarity_matrix
+
+
+def make_synthetic_scores(num_query, num_gallery, num_ids, num_cams, rng):
+    query_ids = rng.integers(0, num_ids, num_query)
+    query_cams = rng.integers(0, num_cams, num_query)
+    gallery_ids = np.concatenate([query_ids, rng.integers(0, num_ids, num_gallery - num_query)])
+    gallery_cams = np.concatenate([(query_cams + 1) % num_cams, rng.integers(0, num_cams, num_gallery - num_query)])
+    scores = rng.normal(size = (num_query, num_gallery)) + 2. * (query_ids[:, None] == gallery_ids[None, :])
+    return scores.astype(np.float32), query_ids, query_cams, gallery_ids, gallery_cams
+
+
+def legacy_cross_camera(scores, query_ids, query_cams, gallery_ids, gallery_cams):
+    """Rank-1 and mAP exactly as test.py computed them from the cos_dist cube"""
+    cos_dist = np.zeros((len(query_ids), len(gallery_ids) + 1, 3))
+    cos_dist[:, :-1, 0] = gallery_ids
+    cos_dist[:, :-1, 1] = gallery_cams
+    cos_dist[:, :-1, 2] = scores
+    cos_dist[:, -1, 0] = query_ids
+    cos_dist[:, -1, 1] = query_cams
+
+    correct = 0
+    map_sum = 0
+    for element in cos_dist:
+        person_id = element[-1, 0]
+        camera_id = element[-1, 1]
+        element = np.delete(element, np.where(element[:, 1] == camera_id), axis=0)
+        element = element[element[:, -1].argsort()]
+        if element[-1][0] == person_id:
+            correct += 1
+        map_sum += average_precision_score(element[:, 0] == person_id, element[:, 2])
+    return correct / len(cos_dist), map_sum / len(cos_dist)
+
+
+def reference_market(scores, query_ids, query_cams, gallery_ids, gallery_cams):
+    """Straightforward per-query loop for the same-id same-camera protocol"""
+    rank_1 = 0
+    map_sum = 0
+    for i in range(len(query_ids)):
+        keep = ~((gallery_ids == query_ids[i]) & (gallery_cams == query_cams[i]))
+        y_true = gallery_ids[keep] == query_ids[i]
+        y_score = scores[i, keep]
+        rank_1 += y_true[np.argmax(y_score)]
+        map_sum += average_precision_score(y_true, y_score)
+    return rank_1 / len(query_ids), map_sum / len(query_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Metrics check")
+    parser.add_argument('--num_query', type = int, default = 300, help = 'Number of synthetic queries')
+    parser.add_argument('--num_gallery', type = int, default = 2000, help = 'Number of synthetic gallery images')
+    parser.add_argument('--num_ids', type = int, default = 100, help = 'Number of synthetic person ids')
+    parser.add_argument('--num_cams', type = int, default = 6, help = 'Number of synthetic cameras')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Random seed')
+    opt = parser.parse_args()
+
+    data = make_synthetic_scores(opt.num_query, opt.num_gallery, opt.num_ids, opt.num_cams, np.random.default_rng(opt.seed))
+
+    for cross_camera, reference in [(True, legacy_cross_camera), (False, reference_market)]:
+        expected_rank_1, expected_mAP = reference(*data)
+        cmc, mAP, mINP = evaluate(*data, cross_camera = cross_camera, chunk_size = 64)
+        print('cross_camera={}: Rank-1 {:.6f} / {:.6f}, mAP {:.6f} / {:.6f}, mINP {:.6f}'.format(
+            cross_camera, cmc[0], expected_rank_1, mAP, expected_mAP, mINP))
+        assert np.isclose(cmc[0], expected_rank_1) and np.isclose(mAP, expected_mAP)
+
+    rng = np.random.default_rng(opt.seed)
+    query_ids, query_cams, gallery_ids, gallery_cams = data[1:]
+    centers = rng.normal(size = (opt.num_ids, 128))
+    query = centers[query_ids] + 2. * rng.normal(size = (len(query_ids), 128))
+    gallery = centers[gallery_ids] + 2. * rng.normal(size = (len(gallery_ids), 128))
+    scores = cosine_similarity_matrix(query, gallery)
+    for cross_camera in [True, False]:
+        cmc, mAP, mINP = evaluate(scores, query_ids, query_cams, gallery_ids, gallery_cams, cross_camera = cross_camera)
+        _, _, topk_cmc, topk_mAP, topk_mINP = topk_ranking(query, gallery, query_ids, query_cams, gallery_ids, gallery_cams, k = 10,
+                                                           cross_camera = cross_camera, memory_budget = 4 * 64 * 500)
+        print('top-k cross_camera={}: mAP {:.6f} / {:.6f}, mINP {:.6f} / {:.6f}'.format(cross_camera, topk_mAP, mAP, topk_mINP, mINP))
+        assert np.allclose(topk_cmc, cmc) and np.isclose(topk_mAP, mAP) and np.isclose(topk_mINP, mINP)
+    print('OK')
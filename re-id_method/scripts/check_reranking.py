@@ -0,0 +1,70 @@
+"""Checks the sparse k-reciprocal re-ranking of util.reranking against a dense
+per-item implementation of the same algorithm and times both.
+
+Run from re-id_method: python -m scripts.check_reranking
+"""
+import argparse
+from time import time
+import numpy as np
+from util.reranking import RerankedScores
+from util.similarity import normalize_descriptors
+
+
+def reference_reranking(query, gallery, k1, k2, lambda_value):
+    """Dense (Q + G)^2 re-ranking following the loops of the original k-reciprocal code"""
+    features = normalize_descriptors(np.concatenate([query, gallery]))
+    num_query, num_all = len(query), len(features)
+    distance = 1. - features @ features.T
+    initial_rank = np.argsort(-(features @ features.T), axis = 1, kind = 'stable')
+
+    def k_reciprocal(i, k):
+        forward = initial_rank[i, :k + 1]
+        backward = initial_rank[forward, :k + 1]
+        return forward[np.where(backward == i)[0]]
+
+    V = np.zeros((num_all, num_all), dtype = np.float32)
+    for i in range(num_all):
+        reciprocal = k_reciprocal(i, k1)
+        expansion = reciprocal
+        for candidate in reciprocal:
+            candidate_reciprocal = k_reciprocal(candidate, int(np.around(k1 / 2.)))
+            if len(np.intersect1d(candidate_reciprocal, reciprocal)) > 2. / 3 * len(candidate_reciprocal):
+                expansion = np.append(expansion, candidate_reciprocal)
+        expansion = np.unique(expansion)
+        weight = np.exp(-distance[i, expansion])
+        V[i, expansion] = weight / np.sum(weight)
+    if k2 > 1:
+        V = np.stack([V[initial_rank[i, :k2]].mean(0) for i in range(num_all)])
+
+    jaccard = np.zeros((num_query, num_all - num_query), dtype = np.float32)
+    for i in range(num_query):
+        minimum = np.minimum(V[i][None, :], V[num_query:]).sum(1)
+        maximum = np.maximum(V[i][None, :], V[num_query:]).sum(1)
+        jaccard[i] = 1. - minimum / maximum
+    return -((1. - lambda_value) * jaccard + lambda_value * distance[:num_query, num_query:])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "k-reciprocal re-ranking check")
+    parser.add_argument('--num_query', type = int, default = 100, help = 'Number of synthetic queries')
+    parser.add_argument('--num_gallery', type = int, default = 700, help = 'Number of synthetic gallery descriptors')
+    parser.add_argument('--k1', type = int, default = 20, help = 'k1 of k-reciprocal neighbors')
+    parser.add_argument('--k2', type = int, default = 6, help = 'k2 of local query expansion')
+    opt = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size = (opt.num_gallery // 10, 64))
+    query = (centers[rng.integers(0, len(centers), opt.num_query)] + rng.normal(size = (opt.num_query, 64))).astype(np.float32)
+    gallery = (centers[rng.integers(0, len(centers), opt.num_gallery)] + rng.normal(size = (opt.num_gallery, 64))).astype(np.float32)
+
+    start = time()
+    expected = reference_reranking(query, gallery, opt.k1, opt.k2, 0.3)
+    dense_time = time() - start
+    start = time()
+    reranked = RerankedScores(query, gallery, opt.k1, opt.k2, 0.3, memory_budget = 2 ** 20)
+    scores = np.concatenate([reranked[start:start + reranked.block_size] for start in range(0, len(query), reranked.block_size)])
+    sparse_time = time() - start
+
+    print('dense {:.2f} s, sparse {:.2f} s, max difference {:.2e}'.format(dense_time, sparse_time, np.abs(scores - expected).max()))
+    assert np.allclose(scores, expected, atol = 1e-5)
+    print('OK')
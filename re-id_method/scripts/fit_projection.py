@@ -0,0 +1,69 @@
+"""Fits the PCA descriptor projection of a checkpoint and reports the accuracy trade-off.
+
+Embeds bounding_box_train (with test preprocessing), fits a PCA projection for every
+requested dimension, and evaluates raw and projected query / gallery descriptors in
+float32 and float16. The projection of --dim is saved as
+checkpoints/<name>/projection_<suffix>.npz; test.py then applies it automatically.
+
+Run from re-id_method, e.g.
+    python -m scripts.fit_projection --dataroot ../DukeMTMC-reID --name DukeMTMC --dims 128 256 512 --dim 256 --whiten
+"""
+import argparse
+import os.path as osp
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from data.dataset import Dataset_loader, get_transforms, get_test_dataset_loader, get_query_dataset_loader
+from models.re_id_model import get_model
+from util.extraction import extract_descriptors, prepare_inference_model
+from util.metrics import evaluate
+from util.projection import fit_projection, get_projection_path
+from util.similarity import cosine_similarity_matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "PCA descriptor projection")
+    parser.add_argument('--dataroot', type = str, required = True, help = 'path to images root(Duke style)')
+    parser.add_argument('--name', type = str, required = True, help = 'Name of the experiment to load')
+    parser.add_argument('--initial_suffix', type = str, default = 'latest', help = 'Intital suffix')
+    parser.add_argument('--dims', type = int, nargs = '+', default = [256, 512], help = 'Projection dimensions to evaluate')
+    parser.add_argument('--dim', type = int, default = 0, help = 'Projection dimension to save, nothing is saved if 0')
+    parser.add_argument('--whiten', action = 'store_true', help = 'Whiten projected descriptors')
+    parser.add_argument('--l2', action = 'store_true', help = 'L2-normalize projected descriptors')
+    parser.add_argument('--max_train_images', type = int, default = 0, help = 'If positive, fit on a random sample of this many training images')
+    parser.add_argument('--batch_size', type = int, default = 32, help = 'Batch size')
+    parser.add_argument('--num_workers', type = int, default = 4, help = 'Number of DataLoader workers')
+    parser.add_argument('--gpu_id', type = int, default = 0, help = 'Specify gpu ids if -1 than CPU')
+    parser.add_argument('--market_protocol', action = 'store_true', help = 'Discard only same person same camera gallery images instead of every same camera image')
+    opt = parser.parse_args()
+    device = torch.device(opt.gpu_id) if (torch.cuda.is_available() and opt.gpu_id >= 0) else torch.device("cpu")
+    load_path = osp.join("./checkpoints", opt.name)
+
+    backbone = prepare_inference_model(get_model(1, load_path, opt.initial_suffix, True, device).get_backbone_model())
+
+    def embed(dataset):
+        loader = DataLoader(dataset, batch_size = opt.batch_size, shuffle = False, num_workers = opt.num_workers)
+        return extract_descriptors(backbone, loader, device)
+
+    train_data = Dataset_loader(opt.dataroot, "Train", get_transforms("Test"))
+    if opt.max_train_images > 0:
+        train_data = Subset(train_data, torch.randperm(len(train_data))[:opt.max_train_images].tolist())
+    print('Embedding {} training images'.format(len(train_data)))
+    train_features = embed(train_data)[0]
+    query, query_ids, query_cams = embed(get_query_dataset_loader(opt.dataroot))
+    gallery, gallery_ids, gallery_cams = embed(get_test_dataset_loader(opt.dataroot))
+
+    def report(name, query, gallery):
+        for dtype in [np.float32, np.float16]:
+            scores = cosine_similarity_matrix(query.astype(dtype), gallery.astype(dtype))
+            cmc, mAP, _ = evaluate(scores, query_ids, query_cams, gallery_ids, gallery_cams, cross_camera = not opt.market_protocol)
+            print('{:14s} {:8s}: {:6d} bytes/descriptor, Rank-1 {:.2f}, mAP {:.2f}'.format(
+                name, np.dtype(dtype).name, gallery.shape[1] * np.dtype(dtype).itemsize, cmc[0] * 100, mAP * 100))
+
+    report('raw 4096', query, gallery)
+    for dim in sorted(set(opt.dims + ([opt.dim] if opt.dim > 0 else []))):
+        projection = fit_projection(train_features, dim, opt.whiten, opt.l2)
+        report('PCA {}{}'.format(dim, ' whiten' if opt.whiten else ''), projection.apply(query), projection.apply(gallery))
+        if dim == opt.dim:
+            projection.save(get_projection_path(load_path, opt.initial_suffix))
+            print('Saved {}'.format(get_projection_path(load_path, opt.initial_suffix)))
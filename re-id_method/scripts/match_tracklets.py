@@ -0,0 +1,121 @@
+"""Matches query tracklets against gallery tracklets with one pooled descriptor per tracklet.
+
+Frames of every tracklet are read in batches through a bounded queue, embedded, and
+pooled on the fly into one descriptor per tracklet ('mean' or 'quality'-weighted, see
+util.tracklets.pool_tracklets), so ranking and evaluation work on tracklets instead of
+frames. Tracklets are <pid>C<cam>T<tracklet> frame groups of MARS <pid>/ folders,
+DukeMTMC-VideoReID <pid>/<tracklet>/ folders of crops or <pid>_c<cam> groups of a flat
+Duke style folder, see data.tracklets.scan_tracklets.
+
+Pooled descriptors are saved to ./checkpoints/<name>/testing_results/tracklet_<split>_descriptors_<suffix>
+and reused while the checkpoint file, pooling and preprocessing stay the same.
+
+Run from re-id_method, e.g.
+    python -m scripts.match_tracklets --name DukeMTMC --query_dir ../DukeMTMC-VideoReID/query --gallery_dir ../DukeMTMC-VideoReID/gallery
+    python -m scripts.match_tracklets --name DukeMTMC --query_dir ../DukeMTMC-reID/query --gallery_dir ../DukeMTMC-reID/bounding_box_test --pooling quality
+"""
+import argparse
+import os
+import os.path as osp
+from time import time
+import numpy as np
+import torch
+from data.dataset import get_transforms
+from data.tracklets import scan_tracklets, iterate_frame_batches
+from models.re_id_model import get_model, get_folded_backbone
+from util.descriptor_store import DescriptorStore, load_descriptor_store
+from util.extraction import prepare_inference_model
+from util.incremental import get_file_signature
+from util.metrics import evaluate
+from util.projection import load_projection
+from util.ranking import topk_ranking
+from util.similarity import cosine_similarity_matrix
+from util.tracklets import pool_tracklets
+
+
+def get_tracklet_store(root_dir, path, header, backbone, projection, device, opt):
+    """Loads pooled tracklet descriptors of root_dir from path if they match header, otherwise computes and saves them"""
+    names, frame_paths, person_ids, camera_ids = scan_tracklets(root_dir)
+    store = None if opt.no_load else load_descriptor_store(path, header)
+    if store is not None and list(store.extra['tracklet_names']) == names:
+        return store
+
+    start = time()
+    batches = iterate_frame_batches(frame_paths, get_transforms('Test'), opt.batch_size, opt.queue_size, opt.num_workers, opt.max_frames)
+    features, num_frames = pool_tracklets(backbone, batches, len(names), device, opt.pooling, opt.channels_last, opt.bf16, projection)
+    elapsed = time() - start
+    store = DescriptorStore(features, person_ids, camera_ids, header, extra = {'tracklet_names': np.array(names), 'num_frames': num_frames})
+    store.save(path)
+    print('{}: {} frames of {} tracklets in {:.1f} s ({:.1f} frames/s)'.format(root_dir, num_frames.sum(), len(names), elapsed,
+                                                                            num_frames.sum() / max(elapsed, 1e-9)))
+    return DescriptorStore.load(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Tracklet re-id")
+    parser.add_argument('--name', type = str, required = True, help = 'Name of the experiment to load')
+    parser.add_argument('--suffix', type = str, default = 'latest', help = 'Suffix of the backbone checkpoint')
+    parser.add_argument('--query_dir', type = str, required = True, help = 'Folder of query tracklets')
+    parser.add_argument('--gallery_dir', type = str, required = True, help = 'Folder of gallery tracklets')
+    parser.add_argument('--pooling', type = str, default = 'mean', choices = ['mean', 'quality'], help = 'Pooling of frame descriptors into a tracklet descriptor')
+    parser.add_argument('--max_frames', type = int, default = 0, help = 'If positive, embed only this many evenly spaced frames of every tracklet')
+    parser.add_argument('--batch_size', type = int, default = 64, help = 'Number of frames embedded at once')
+    parser.add_argument('--queue_size', type = int, default = 4, help = 'Number of decoded batches waiting for the backbone')
+    parser.add_argument('--num_workers', type = int, default = 4, help = 'Number of frame decoding threads')
+    parser.add_argument('--top_k', type = int, default = 0, help = 'If positive, keep and save only top-k gallery tracklets per query tracklet')
+    parser.add_argument('--no_load', action = 'store_true', help = 'Re-embed tracklets even if pooled descriptors are stored')
+    parser.add_argument('--no_projection', action = 'store_true', help = 'Do not apply the PCA projection saved with the checkpoint')
+    parser.add_argument('--fold_bn', action = 'store_true', help = 'Use the backbone with BatchNorms folded into convolutions')
+    parser.add_argument('--channels_last', action = 'store_true', help = 'Run the backbone in channels_last memory format')
+    parser.add_argument('--bf16', action = 'store_true', help = 'Run the backbone under bfloat16 autocast')
+    parser.add_argument('--market_protocol', action = 'store_true', help = 'Discard only same person same camera gallery tracklets instead of every same camera tracklet')
+    parser.add_argument('--memory_budget', type = int, default = 256, help = 'Memory budget in MB for one tile of query-gallery similarities')
+    parser.add_argument('--gpu_id', type = int, default = -1, help = 'Specify gpu ids if -1 than CPU')
+    opt = parser.parse_args()
+    device = torch.device(opt.gpu_id) if (torch.cuda.is_available() and opt.gpu_id >= 0) else torch.device("cpu")
+
+    load_path = osp.join('./checkpoints', opt.name)
+    save_path = osp.join(load_path, 'testing_results')
+    if not osp.exists(save_path):
+        os.makedirs(save_path)
+
+    if opt.fold_bn:
+        backbone = get_folded_backbone(load_path, opt.suffix, device)
+    else:
+        backbone = get_model(1, load_path, opt.suffix, True, device).get_backbone_model()
+    backbone = prepare_inference_model(backbone, opt.channels_last)
+    projection = None if opt.no_projection else load_projection(load_path, opt.suffix)
+
+    checkpoint_path = osp.join(load_path, 'backbone_{}.pth'.format(opt.suffix))
+    if opt.fold_bn and not osp.exists(checkpoint_path):
+        checkpoint_path = osp.join(load_path, 'backbone_folded_{}.pth'.format(opt.suffix))
+    header = {'suffix': opt.suffix, 'checkpoint': get_file_signature(checkpoint_path), 'preprocessing': repr(get_transforms('Test')), 'pooling': opt.pooling, 'max_frames': opt.max_frames,
+              'precision': 'bfloat16' if opt.bf16 else 'float32', 'projection': None if projection is None else projection.get_config()}
+    query = get_tracklet_store(opt.query_dir, osp.join(save_path, 'tracklet_query_descriptors_{}'.format(opt.suffix)),
+                               header, backbone, projection, device, opt)
+    gallery = get_tracklet_store(opt.gallery_dir, osp.join(save_path, 'tracklet_gallery_descriptors_{}'.format(opt.suffix)),
+                                 header, backbone, projection, device, opt)
+    print('Query: {} tracklets of {} frames, gallery: {} tracklets of {} frames'.format(
+        len(query), query.extra['num_frames'].sum(), len(gallery), gallery.extra['num_frames'].sum()))
+
+    start = time()
+    if opt.top_k > 0:
+        top_indices, top_scores, cmc, mAP, mINP = topk_ranking(query.features, gallery.features, query.person_ids, query.camera_ids,
+                                                               gallery.person_ids, gallery.camera_ids, opt.top_k,
+                                                               cross_camera = not opt.market_protocol, memory_budget = opt.memory_budget * 2 ** 20)
+        np.save(osp.join(save_path, 'tracklet_ranking_indices_{}.npy'.format(opt.suffix)), top_indices)
+        np.save(osp.join(save_path, 'tracklet_ranking_scores_{}.npy'.format(opt.suffix)), top_scores)
+    else:
+        scores = cosine_similarity_matrix(query.features, gallery.features, opt.memory_budget * 2 ** 20)
+        cmc, mAP, mINP = evaluate(scores, query.person_ids, query.camera_ids, gallery.person_ids, gallery.camera_ids,
+                                  cross_camera = not opt.market_protocol)
+    print('Matching: {:.3f} s'.format(time() - start))
+
+    with open(osp.join(save_path, 'tracklet_result_{}.txt'.format(opt.suffix)), 'w') as result:
+        for rank in [r for r in [1, 5, 10] if r <= len(cmc)]:
+            result.write("Rank-{}: {}\n".format(rank, cmc[rank - 1] * 100))
+            print("Rank-{}: ".format(rank), cmc[rank - 1] * 100)
+        result.write("mAP: {}\n".format(mAP * 100))
+        print("mAP: ", mAP * 100)
+        result.write("mINP: {}\n".format(mINP * 100))
+        print("mINP: ", mINP * 100)
@@ -0,0 +1,73 @@
+"""Quantizes the backbone of a checkpoint to int8 and reports its accuracy and speed.
+
+Calibrates static int8 quantization on a random sample of bounding_box_train
+(with test preprocessing), saves the model as checkpoints/<name>/backbone_int8_<suffix>.pt
+(used by test.py --int8), then embeds query and gallery images with the float32
+and the int8 backbone and reports rank-1 / mAP of both and images/s on CPU.
+
+Run from re-id_method, e.g.
+    python -m scripts.quantize_backbone --dataroot ../DukeMTMC-reID --name DukeMTMC --num_calibration 512
+"""
+import argparse
+import os.path as osp
+from time import time
+import torch
+from torch.utils.data import DataLoader, Subset
+from data.dataset import Dataset_loader, get_transforms, get_test_dataset_loader, get_query_dataset_loader
+from models.quantization import quantize_backbone, save_quantized_backbone, load_quantized_backbone
+from models.re_id_model import get_model
+from util.extraction import extract_descriptors, prepare_inference_model
+from util.metrics import evaluate
+from util.similarity import cosine_similarity_matrix
+
+
+def evaluate_backbone(backbone, query_loader, gallery_loader, cross_camera):
+    """Returns rank-1, mAP and images/s of a backbone on CPU"""
+    start = time()
+    query, query_ids, query_cams = extract_descriptors(backbone, query_loader, 'cpu')
+    gallery, gallery_ids, gallery_cams = extract_descriptors(backbone, gallery_loader, 'cpu')
+    images_per_second = (len(query) + len(gallery)) / (time() - start)
+    cmc, mAP, _ = evaluate(cosine_similarity_matrix(query, gallery), query_ids, query_cams, gallery_ids, gallery_cams,
+                           cross_camera = cross_camera)
+    return cmc[0], mAP, images_per_second
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Int8 backbone quantization")
+    parser.add_argument('--dataroot', type = str, required = True, help = 'path to images root(Duke style)')
+    parser.add_argument('--name', type = str, required = True, help = 'Name of the experiment to load')
+    parser.add_argument('--initial_suffix', type = str, default = 'latest', help = 'Intital suffix')
+    parser.add_argument('--num_calibration', type = int, default = 512, help = 'Number of bounding_box_train images for calibration')
+    parser.add_argument('--backend', type = str, default = 'x86', choices = ['x86', 'fbgemm', 'qnnpack'], help = 'Quantized engine')
+    parser.add_argument('--batch_size', type = int, default = 32, help = 'Batch size')
+    parser.add_argument('--num_workers', type = int, default = 4, help = 'Number of DataLoader workers')
+    parser.add_argument('--num_threads', type = int, default = 0, help = 'Number of CPU threads, torch default if 0')
+    parser.add_argument('--market_protocol', action = 'store_true', help = 'Discard only same person same camera gallery images instead of every same camera image')
+    parser.add_argument('--no_eval', action = 'store_true', help = 'Only quantize and save the backbone')
+    opt = parser.parse_args()
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    torch.backends.quantized.engine = opt.backend
+    load_path = osp.join("./checkpoints", opt.name)
+
+    backbone = get_model(1, load_path, opt.initial_suffix, True).get_backbone_model()
+
+    train_data = Dataset_loader(opt.dataroot, "Train", get_transforms("Test"))
+    sample = torch.randperm(len(train_data))[:opt.num_calibration].tolist()
+    calibration_loader = DataLoader(Subset(train_data, sample), batch_size = opt.batch_size, num_workers = opt.num_workers)
+    print('Calibrating on {} training images'.format(len(sample)))
+    save_quantized_backbone(quantize_backbone(backbone, calibration_loader, opt.backend), load_path, opt.initial_suffix)
+    print('Saved {}'.format(osp.join(load_path, "backbone_int8_{}.pt".format(opt.initial_suffix))))
+
+    if not opt.no_eval:
+        query_loader = DataLoader(get_query_dataset_loader(opt.dataroot), batch_size = opt.batch_size, num_workers = opt.num_workers)
+        gallery_loader = DataLoader(get_test_dataset_loader(opt.dataroot), batch_size = opt.batch_size, num_workers = opt.num_workers)
+        results = {}
+        for precision, model in [('float32', prepare_inference_model(backbone.cpu())),
+                                 ('int8', load_quantized_backbone(load_path, opt.initial_suffix))]:
+            results[precision] = evaluate_backbone(model, query_loader, gallery_loader, not opt.market_protocol)
+            print('{:7s}: Rank-1 {:.2f}, mAP {:.2f}, {:.1f} images/s'.format(precision, results[precision][0] * 100,
+                                                                             results[precision][1] * 100, results[precision][2]))
+        print('Drift: Rank-1 {:+.2f}, mAP {:+.2f}, speedup {:.2f}x'.format((results['int8'][0] - results['float32'][0]) * 100,
+                                                                         (results['int8'][1] - results['float32'][1]) * 100,
+                                                                         results['int8'][2] / results['float32'][2]))
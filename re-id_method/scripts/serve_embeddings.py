@@ -0,0 +1,180 @@
+"""Serves re-id descriptors of person crops over HTTP, on a TCP port or a Unix socket.
+
+The backbone is loaded once. Concurrent requests are collected into micro-batches
+of at most --max_batch_size crops, waiting at most --max_wait_ms for more, which
+--num_workers threads run through the backbone. Crops are decoded and preprocessed
+like test images (get_transforms('Test')) in the request threads. Descriptors are
+projected with the PCA projection saved with the checkpoint, as in test.py.
+
+Endpoints:
+    POST /embed     body: one JPEG / PNG crop (top-k from the ?top_k= query), or JSON
+                    {"images": [base64 crops], "top_k": k}; returns JSON
+                    {"descriptors": [[...]], "matches": [[{"index", "score", "person_id",
+                    "camera_id", "image_name"}]] or null}
+    GET /metrics    request, queue wait and inference latency histograms and micro-batch sizes
+    GET /health     {"status": "ok"}
+
+Top-k matches need --gallery, a descriptor store saved by test.py with the same model
+(e.g. ./checkpoints/<name>/testing_results/gallery_descriptors_<suffix>).
+
+Run from re-id_method, e.g.
+    python -m scripts.serve_embeddings --name DukeMTMC --gallery ./checkpoints/DukeMTMC/testing_results/gallery_descriptors_latest --port 8000
+    python -m scripts.serve_embeddings --name DukeMTMC --unix_socket /tmp/re-id.sock --max_batch_size 64 --max_wait_ms 10
+    curl --data-binary @crop.jpg 'localhost:8000/embed?top_k=5'
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import os.path as osp
+import socket
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import torch
+from PIL import Image
+from data.dataset import get_transforms
+from models.quantization import load_quantized_backbone
+from models.re_id_model import get_model, get_folded_backbone
+from util.descriptor_store import DescriptorStore
+from util.extraction import embed_batch, prepare_inference_model
+from util.projection import load_projection
+from util.serving import MicroBatcher, EmbeddingService
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    """Handles requests of an EmbeddingService attached to the server as server.service"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self.send_json(200, self.server.service.get_metrics())
+        elif path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/embed':
+            self.send_json(404, {'error': 'unknown path {}'.format(url.path)})
+            return
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                request = json.loads(body)
+                crops, top_k = [base64.b64decode(image) for image in request['images']], int(request.get('top_k', 0))
+            else:
+                crops, top_k = [body], int(parse_qs(url.query).get('top_k', [0])[0])
+            images = torch.stack([self.server.transform(Image.open(io.BytesIO(crop)).convert('RGB')) for crop in crops])
+        except Exception as error:
+            self.send_json(400, {'error': 'bad request: {}'.format(error)})
+            return
+        try:
+            features, matches = self.server.service.embed(images, top_k)
+        except Exception as error:
+            self.send_json(500, {'error': str(error)})
+            return
+        self.send_json(200, {'descriptors': features.tolist(), 'matches': matches})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+def load_backbone(opt, device):
+    """Loads the backbone to serve; the int8 backbone always stays on CPU"""
+    load_path = './checkpoints/{}'.format(opt.name) if opt.name is not None else None
+    if opt.int8:
+        return load_quantized_backbone(load_path, opt.suffix)
+    if opt.fold_bn:
+        return get_folded_backbone(load_path, opt.suffix, device)
+    return get_model(1, load_path, opt.suffix, True, device).get_backbone_model()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Re-id embedding service")
+    parser.add_argument('--name', type = str, default = None, help = 'Experiment to load the backbone from, ImageNet weights if not specified')
+    parser.add_argument('--suffix', type = str, default = 'latest', help = 'Suffix of the backbone checkpoint')
+    parser.add_argument('--gallery', type = str, default = None, help = 'Descriptor store to return top-k matches from, no matches if not specified')
+    parser.add_argument('--host', type = str, default = '127.0.0.1', help = 'Host to listen on')
+    parser.add_argument('--port', type = int, default = 8000, help = 'TCP port to listen on')
+    parser.add_argument('--unix_socket', type = str, default = None, help = 'Listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--max_batch_size', type = int, default = 32, help = 'Largest number of crops in a micro-batch')
+    parser.add_argument('--max_wait_ms', type = float, default = 5., help = 'Longest time in ms a micro-batch waits for more requests')
+    parser.add_argument('--num_workers', type = int, default = 1, help = 'Number of threads running micro-batches')
+    parser.add_argument('--num_threads', type = int, default = 0, help = 'Number of torch CPU threads, torch default if 0')
+    parser.add_argument('--no_projection', action = 'store_true', help = 'Do not apply the PCA projection saved with the checkpoint')
+    parser.add_argument('--int8', action = 'store_true', help = 'Use the int8 backbone made by scripts.quantize_backbone (CPU only)')
+    parser.add_argument('--fold_bn', action = 'store_true', help = 'Use the backbone with BatchNorms folded into convolutions')
+    parser.add_argument('--channels_last', action = 'store_true', help = 'Run the backbone in channels_last memory format')
+    parser.add_argument('--bf16', action = 'store_true', help = 'Run the backbone under bfloat16 autocast')
+    parser.add_argument('--memory_budget', type = int, default = 256, help = 'Memory budget in MB for one tile of query-gallery similarities')
+    parser.add_argument('--verbose', action = 'store_true', help = 'Log every request')
+    parser.add_argument('--gpu_id', type = int, default = -1, help = 'Specify gpu ids if -1 than CPU')
+    opt = parser.parse_args()
+    if opt.name is None and (opt.int8 or opt.fold_bn):
+        parser.error('--int8 and --fold_bn load backbones saved with a checkpoint, specify the experiment with --name')
+    device = torch.device(opt.gpu_id) if (torch.cuda.is_available() and opt.gpu_id >= 0 and not opt.int8) else torch.device("cpu")
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+
+    backbone = prepare_inference_model(load_backbone(opt, device), opt.channels_last)
+    projection = None
+    if opt.name is not None and not opt.no_projection:
+        projection = load_projection('./checkpoints/{}'.format(opt.name), opt.suffix)
+
+    def embed(images):
+        features = embed_batch(backbone, images, device, opt.channels_last, opt.bf16)
+        return features if projection is None else projection.apply(features)
+
+    gallery = None
+    if opt.gallery is not None:
+        gallery = DescriptorStore.load(opt.gallery)
+        expected = None if projection is None else projection.get_config()
+        if gallery.header.get('projection') != expected or gallery.header.get('suffix', opt.suffix) != opt.suffix:
+            print('Warning: gallery descriptors were made with suffix {} and projection {}, served with suffix {} and projection {}'.format(
+                gallery.header.get('suffix'), gallery.header.get('projection'), opt.suffix, expected))
+        print('Loaded {} gallery descriptors'.format(len(gallery)))
+
+    service = EmbeddingService(MicroBatcher(embed, opt.max_batch_size, opt.max_wait_ms / 1000, opt.num_workers),
+                               gallery, opt.memory_budget * 2 ** 20)
+    if opt.unix_socket is not None:
+        if osp.exists(opt.unix_socket):
+            os.remove(opt.unix_socket)
+        server = UnixHTTPServer(opt.unix_socket, EmbeddingHandler)
+        print('Serving on {}'.format(opt.unix_socket))
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), EmbeddingHandler)
+        print('Serving on http://{}:{}'.format(opt.host, opt.port))
+    server.service, server.transform, server.verbose = service, get_transforms('Test'), opt.verbose
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.batcher.close()
@@ -1,129 +1,140 @@
-from tqdm import tqdm
 from data.dataset import get_test_dataset_loader, get_query_dataset_loader
-from models.re_id_model import get_model
+from models.quantization import load_quantized_backbone
+from models.re_id_model import get_model, get_folded_backbone
 from options.options import Options
+from util.expansion import query_expansion, database_augmentation
+from util.extraction import extract_descriptors, prepare_inference_model, TestTimeAugmentation
+from util.incremental import refresh_descriptor_store, get_file_signature
+from util.metrics import evaluate
+from util.projection import load_projection
+from util.ranking import topk_ranking
+from util.reranking import RerankedScores
+from util.similarity import cosine_similarity_matrix
 import numpy as np
-import torch
-import torch.nn as nn
 import os.path as osp
-from sklearn.metrics import average_precision_score
+from time import time
 from torch.utils.data import DataLoader
 
+def get_image_embedder(get_dataset_loader, backbone_model, opt, projection = None):
+    """Returns a function computing (features, person ids, camera ids) of given image names, projecting features if given a projection"""
+    def embed_images(img_names):
+        dataloader = DataLoader(get_dataset_loader(opt.dataroot, img_names, opt.cache_dir, opt.num_workers), batch_size = opt.batch_size, shuffle = False, num_workers = opt.num_workers)
+        features, person_ids, camera_ids = extract_descriptors(backbone_model, dataloader, opt.device, opt.channels_last, opt.bf16)
+        return (features if projection is None else projection.apply(features)), person_ids, camera_ids
+    return embed_images
+
 if __name__ == "__main__":
 
     opt = Options(is_train = False).parse()
 
-    test_data = get_test_dataset_loader(opt.dataroot) 
-    test_dataloader = DataLoader(test_data, batch_size = opt.batch_size, shuffle = False)
+    test_data = get_test_dataset_loader(opt.dataroot, cache_dir = opt.cache_dir, num_workers = opt.num_workers)
     print('The number of testing images = %d' % len(test_data))
     print('The number of testing classes = %d' % test_data.total_ids)
 
-    query_data = get_query_dataset_loader(opt.dataroot)
-    dataloader_query = DataLoader(query_data, batch_size = 1, shuffle=False)
+    query_data = get_query_dataset_loader(opt.dataroot, cache_dir = opt.cache_dir, num_workers = opt.num_workers)
     print('The number of query images = %d' % len(query_data))
     print('The number of query classes = %d' % query_data.total_ids)
 
 
-    model = get_model(1, opt.load_weights_path, opt.initial_suffix, opt.only_backbone, opt.device) 
-    # print(model)
+    if opt.int8:
+        backbone_model = load_quantized_backbone(opt.load_weights_path, opt.initial_suffix)
+    elif opt.fold_bn:
+        backbone_model = get_folded_backbone(opt.load_weights_path, opt.initial_suffix, opt.device)
+    else:
+        model = get_model(1, opt.load_weights_path, opt.initial_suffix, opt.only_backbone, opt.device) 
+        # print(model)
+        backbone_model = model.get_backbone_model()
+
+    suffix = opt.initial_suffix if opt.save_suffix == '' else opt.save_suffix
+    # descriptors are rebuilt when the checkpoint file is retrained under the same suffix
+    if opt.int8:
+        checkpoint_path = osp.join(opt.load_weights_path, 'backbone_int8_{}.pt'.format(opt.initial_suffix))
+    else:
+        checkpoint_path = osp.join(opt.load_weights_path, 'backbone_{}.pth'.format(opt.initial_suffix))
+        if opt.fold_bn and not osp.exists(checkpoint_path):
+            checkpoint_path = osp.join(opt.load_weights_path, 'backbone_folded_{}.pth'.format(opt.initial_suffix))
+    backbone_model = prepare_inference_model(backbone_model, opt.channels_last)
+    if opt.tta_flip or len(opt.tta_scales) > 0:
+        backbone_model = TestTimeAugmentation(backbone_model, opt.tta_flip, opt.tta_scales)
+        print('Averaging descriptors of {} views per image'.format(backbone_model.num_views))
+    projection = None if opt.no_projection else load_projection(opt.load_weights_path, opt.initial_suffix)
+    if projection is not None:
+        print('Projecting descriptors to {} dimensions'.format(projection.dim))
 
     # Computing gallery descriptors
     print('Computing gallery descriptors')
-    backbone_model = model.get_backbone_model()
-    backbone_model.eval()
-    save_path = osp.join(opt.save_result_path, 'gallery_descriptors_{}.npy'.format(opt.initial_suffix if opt.save_suffix == '' else opt.save_suffix))
-    if osp.exists(save_path) and not opt.no_load:
-        gallery = np.load(save_path, allow_pickle=True)
+    header = {'suffix': opt.initial_suffix, 'checkpoint': get_file_signature(checkpoint_path),
+              'preprocessing': repr(test_data.transform), 'dtype': opt.descriptor_dtype,
+              'precision': 'int8' if opt.int8 else 'bfloat16' if opt.bf16 else 'float32',
+              'projection': None if projection is None else projection.get_config(),
+              'tta': backbone_model.get_config() if isinstance(backbone_model, TestTimeAugmentation) else None}
+    save_path = osp.join(opt.save_result_path, 'gallery_descriptors_{}'.format(suffix))
+    gallery, added, removed = refresh_descriptor_store(save_path, test_data.root_dir, header,
+                                                       get_image_embedder(get_test_dataset_loader, backbone_model, opt, projection), opt.no_load)
+    print('Gallery descriptors: {} embedded, {} removed, {} total'.format(added, removed, len(gallery)))
+
+    # Computing query descriptors
+    print('Computing query descriptors')
+    header = {'suffix': opt.initial_suffix, 'checkpoint': get_file_signature(checkpoint_path),
+              'preprocessing': repr(query_data.transform), 'dtype': opt.descriptor_dtype,
+              'precision': 'int8' if opt.int8 else 'bfloat16' if opt.bf16 else 'float32',
+              'projection': None if projection is None else projection.get_config(),
+              'tta': backbone_model.get_config() if isinstance(backbone_model, TestTimeAugmentation) else None}
+    save_path = osp.join(opt.save_result_path, 'query_descriptors_{}'.format(suffix))
+    query, added, removed = refresh_descriptor_store(save_path, query_data.root_dir, header,
+                                                     get_image_embedder(get_query_dataset_loader, backbone_model, opt, projection), opt.no_load)
+    print('Query descriptors: {} embedded, {} removed, {} total'.format(added, removed, len(query)))
+
+    query_features, gallery_features = query.features, gallery.features
+    if opt.dba_k > 0:
+        print('Augmenting gallery descriptors with their top-{} neighbors'.format(opt.dba_k))
+        gallery_features = database_augmentation(gallery_features, opt.dba_k, opt.expansion_alpha, opt.memory_budget * 2 ** 20)
+    if opt.qe_k > 0:
+        print('Expanding query descriptors with their top-{} matches'.format(opt.qe_k))
+        query_features = query_expansion(query_features, gallery_features, opt.qe_k, opt.expansion_alpha, opt.memory_budget * 2 ** 20)
+
+    if opt.top_k > 0:
+        # Ranking only top-k gallery images
+        print('Computing top-{} ranking'.format(opt.top_k))
+        top_indices, top_scores, cmc, mAP, mINP = topk_ranking(query_features, gallery_features, query.person_ids, query.camera_ids,
+                                                               gallery.person_ids, gallery.camera_ids, opt.top_k,
+                                                               cross_camera = not opt.market_protocol, memory_budget = opt.memory_budget * 2 ** 20)
+        np.save(osp.join(opt.save_result_path, 'ranking_indices_{}.npy'.format(suffix)), top_indices)
+        np.save(osp.join(opt.save_result_path, 'ranking_scores_{}.npy'.format(suffix)), top_scores)
     else:
-        gallery = []
-        with torch.no_grad():
-            for batch in tqdm(test_dataloader):
-                batch['image'] = batch['image'].to(torch.device(opt.device))
-                output = backbone_model(batch['image'])
-                for i in range(batch['image'].size()[0]):
-                    gallery.append([output[i].view(4096).cpu().numpy(), 
-                                    batch['person_id'][i].cpu().numpy(), 
-                                    batch['camera_id'][i].cpu().numpy()])
-        gallery = np.asarray(gallery)
-        np.save(save_path, gallery)
-
-    # Computing cosine distances
-    print('Computing cosine distanses')
-    save_path = osp.join(opt.save_result_path, 'cos_dist_{}.npy'.format(opt.initial_suffix if opt.save_suffix == '' else opt.save_suffix))
-    if osp.exists(save_path) and not opt.no_load:
-        cos_dist = np.load(save_path, allow_pickle=True)
-    else:
-        cos = nn.CosineSimilarity(dim=0, eps=1e-8)
-        j = 0
-        cos_dist = np.zeros((len(query_data), len(test_data) + 1, 3))
-        with torch.no_grad():
-            for i, batch in enumerate(tqdm(dataloader_query)):
-                batch['image'] = batch['image'].to(torch.device(opt.device))
-                output = backbone_model(batch['image'])
-                output = output.view(1, 4096)
-                
-                for j, gallery_descriptor in enumerate(gallery):
-                    cos_dist[i, j, 0], cos_dist[i, j, 1], cos_dist[i, j, 2] = gallery_descriptor[1], gallery_descriptor[2], cos(output[0].to(torch.device('cpu')), 
-                                                                                                               torch.from_numpy(gallery_descriptor[0])).item()
-                cos_dist[i, j + 1, 0] = batch['person_id'].item()
-                cos_dist[i, j + 1, 1] = batch['camera_id'].item()
-            
-        cos_dist = np.asarray(cos_dist)
-        np.save(save_path, cos_dist)
-
-    # Computing rank-1
-    print('Computing rank-1')
-    correct = 0
-    for element in cos_dist:
-        person_id = element[-1, 0]
-        camera_id = element[-1, 1]
-        
-        element = np.delete(element, np.where(element[:, 1] == camera_id), axis=0)
-        
-        if element[element[:,-1].argsort()][-1][0] == person_id:
-            correct += 1
-
-    rank_1 = correct / cos_dist.shape[0]
-
-    # Computing mAP
-    print('Computing mAP')
-    tp_fn = []
-
-    for element in cos_dist:
-        person_id = element[-1, 0]
-        camera_id = element[-1, 1]
-        
-        tp_fn.append(np.where(np.logical_and(element[:, 0] == person_id, element[:, 1] != camera_id))[0].shape[0])
-
-    i = 0
-    p_r_dots = []
-
-    for element in cos_dist:
-        person_id = element[-1, 0]
-        camera_id = element[-1, 1]
-        
-        element = np.delete(element, np.where(element[:, 1] == camera_id), axis=0)
-        element = element[element[:,-1].argsort()]
-        
-        tmp = np.zeros((element.shape[0], 2))
-        tmp[np.argwhere(element[:, 0] == person_id), 0] = 1
-        tmp[:, 1] = element[:, 2]
-        p_r_dots.append(tmp)
-        
-    p_r_dots = np.asarray(p_r_dots)
-
-
+        # Computing cosine distances
+        print('Computing cosine distanses')
+        scores = cosine_similarity_matrix(query_features, gallery_features, opt.memory_budget * 2 ** 20)
 
-    map_sum = 0
-    for el in p_r_dots:
-        y_true, y_score = el[:, 0], el[:, 1]
-        map_sum += average_precision_score(y_true, y_score)
-        
-    mAP = map_sum / p_r_dots.shape[0]
+        # Computing rank-k, mAP and mINP
+        print('Computing rank-k, mAP and mINP')
+        cmc, mAP, mINP = evaluate(scores, query.person_ids, query.camera_ids, gallery.person_ids, gallery.camera_ids,
+                                  cross_camera = not opt.market_protocol)
 
-    save_path = osp.join(opt.save_result_path, 'result_{}.txt'.format(opt.initial_suffix if opt.save_suffix == '' else opt.save_suffix))
+    save_path = osp.join(opt.save_result_path, 'result_{}.txt'.format(suffix))
     with open(save_path, 'w') as result:
-        result.write("Rank-1: {}\n".format(rank_1 * 100))
-        print("Rank-1: ", rank_1 * 100)
+        for rank in [r for r in [1, 5, 10] if r <= len(cmc)]:
+            result.write("Rank-{}: {}\n".format(rank, cmc[rank - 1] * 100))
+            print("Rank-{}: ".format(rank), cmc[rank - 1] * 100)
         result.write("mAP: {}\n".format(mAP * 100))
-        print("mAP: ", mAP * 100)
\ No newline at end of file
+        print("mAP: ", mAP * 100)
+        result.write("mINP: {}\n".format(mINP * 100))
+        print("mINP: ", mINP * 100)
+
+        if opt.rerank:
+            # Re-ranking on sparse k-reciprocal encodings
+            print('Computing k-reciprocal re-ranking')
+            start = time()
+            reranked = RerankedScores(query_features, gallery_features, opt.k1, opt.k2, opt.rerank_lambda, opt.memory_budget * 2 ** 20)
+            rerank_cmc, rerank_mAP, rerank_mINP = evaluate(reranked, query.person_ids, query.camera_ids, gallery.person_ids, gallery.camera_ids,
+                                                           cross_camera = not opt.market_protocol, chunk_size = reranked.block_size)
+            latency = time() - start
+            result.write("Re-ranking latency: {:.2f} s\n".format(latency))
+            print("Re-ranking latency: {:.2f} s ({:.2f} ms per query)".format(latency, latency * 1000 / len(query)))
+            for rank in [r for r in [1, 5, 10] if r <= len(cmc)]:
+                result.write("Re-ranked Rank-{}: {}\n".format(rank, rerank_cmc[rank - 1] * 100))
+                print("Re-ranked Rank-{}: ".format(rank), rerank_cmc[rank - 1] * 100, "({:+.2f})".format((rerank_cmc[rank - 1] - cmc[rank - 1]) * 100))
+            result.write("Re-ranked mAP: {}\n".format(rerank_mAP * 100))
+            print("Re-ranked mAP: ", rerank_mAP * 100, "({:+.2f})".format((rerank_mAP - mAP) * 100))
+            result.write("Re-ranked mINP: {}\n".format(rerank_mINP * 100))
+            print("Re-ranked mINP: ", rerank_mINP * 100, "({:+.2f})".format((rerank_mINP - mINP) * 100))
\ No newline at end of file
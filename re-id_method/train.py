@@ -1,20 +1,33 @@
 from tqdm import tqdm
-from data.dataset import get_train_dataset_loader
+from data.dataset import get_train_dataset_loader, get_transforms
+from data.feature_cache import get_feature_loader
+from data.sampler import RandomPairSampler, Pair_dataset, PKBatchSampler, get_batch_pairs, get_hard_pairs
 from models.re_id_model import get_model
 from models.scheduler import GradualWarmupScheduler
 from options.options import Options
+from util.incremental import get_file_signature
+import os.path as osp
 import torch
 import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+def get_pair_loader(dataset, pair_source, num_steps, num_workers, opt):
+    """Returns a DataLoader of training pairs (or PK batches) of dataset, drawn with the class tables of pair_source"""
+    if opt.num_instances > 0:
+        return DataLoader(dataset, batch_sampler = PKBatchSampler(pair_source, opt.batch_size // opt.num_instances, opt.num_instances, num_steps),
+                          num_workers = num_workers, pin_memory = opt.device.type == 'cuda', persistent_workers = num_workers > 0)
+    return DataLoader(Pair_dataset(dataset), batch_size = opt.batch_size, sampler = RandomPairSampler(pair_source, num_steps * opt.batch_size),
+                      num_workers = num_workers, pin_memory = opt.device.type == 'cuda', persistent_workers = num_workers > 0)
 
 if __name__ == "__main__":
 
     opt = Options(is_train = True).parse()
 
-    train_data = get_train_dataset_loader(opt.dataroot) 
+    train_data = get_train_dataset_loader(opt.dataroot, opt.cache_dir) 
     print('The number of training images = %d' % len(train_data))
     print('The number of training classes = %d' % train_data.total_ids)
 
-    model = get_model(train_data.total_ids, opt.load_weights_path, opt.initial_suffix, opt.only_backbone, opt.device) 
+    model = get_model(train_data.total_ids, opt.load_weights_path, opt.initial_suffix, opt.only_backbone, opt.device, opt.embedding_dim, opt.share_ident) 
     # print(model)
     print(opt.log_file)
 
@@ -23,6 +36,19 @@ if __name__ == "__main__":
 
 
 
+    num_steps = (len(train_data) + opt.batch_size - 1) // opt.batch_size
+    pair_loader = get_pair_loader(train_data, train_data, num_steps, opt.num_workers, opt)
+
+    feature_loader = None
+    if opt.pretrain_feature_draws > 0 and opt.start_epoch <= opt.pretrain_classifiers_epochs:
+        checkpoint = None if opt.load_weights_path is None else get_file_signature(osp.join(opt.load_weights_path, 'backbone_{}.pth'.format(opt.initial_suffix)))
+        header = {'initial_weights': str(opt.initial_weights), 'initial_suffix': opt.initial_suffix, 'checkpoint': checkpoint,
+                  'dataroot': [osp.abspath(root) for root in opt.dataroot],
+                  'preprocessing': repr(get_transforms("Train", opt.cache_dir is not None))}
+        feature_data = get_feature_loader(osp.join(opt.save_weights_path, 'pretrain_features'), train_data, model.get_backbone_model(),
+                                          opt.pretrain_feature_draws, header, opt.batch_size, opt.num_workers, opt.device)
+        feature_loader = get_pair_loader(feature_data, train_data, num_steps, 0, opt)
+
     optimizer = torch.optim.SGD(model.parameters(), lr = opt.lr) 
     scheduler_lr_red = torch.optim.lr_scheduler.StepLR(optimizer, opt.start_step_lr, 0.1) 
     scheduler_warmup = GradualWarmupScheduler(optimizer, multiplier = 10, total_epoch = opt.warmup_epoch, after_scheduler = scheduler_lr_red) 
@@ -49,37 +75,36 @@ if __name__ == "__main__":
         acc_first_id_val_list = [1]
         acc_second_id_val_list = [1]
         
-        for i in tqdm(range(0, len(train_data), opt.batch_size)): 
+        model.features_input = feature_loader is not None and epoch <= opt.pretrain_classifiers_epochs
+        for batch in tqdm(feature_loader if model.features_input else pair_loader): 
             optimizer.zero_grad()
             
-            images_first = torch.zeros((opt.batch_size, 3, 246, 128), dtype = torch.float32, device = opt.device)
-            images_second = torch.zeros((opt.batch_size, 3, 246, 128), dtype = torch.float32, device = opt.device)
-            persons_id_first = torch.zeros((opt.batch_size, ), dtype = torch.long, device = opt.device)
-            persons_id_second = torch.zeros((opt.batch_size, ), dtype = torch.long, device = opt.device)
-            verification = torch.zeros(opt.batch_size, dtype = torch.long, device = opt.device)
-            
-            for j, k in enumerate(range(i, i + opt.batch_size)):
-                k = torch.randint(0, len(train_data), (1,)).item()
-                first_image = train_data[k]
-                
-                images_first[j] = first_image["image"]
-                persons_id_first[j] = first_image["person_id"]
-                
-                r = torch.rand((1, )).item()
-
-                if r <= 0.4:
-                    verification[j] = 1
-                    idx = train_data.get_random_class_image_idx(persons_id_first[j].item(), True)
+            if opt.num_instances > 0:
+                images = batch['image'].to(opt.device, non_blocking = True)
+                persons_id_first = batch['person_id'].to(opt.device, non_blocking = True)
+                model.sample_classes(persons_id_first, opt.sampled_classes)
+                if opt.all_pairs:
+                    z, x, y, first, second = model.forward_all_pairs(images, epoch <= opt.pretrain_classifiers_epochs)
+                    verification = (persons_id_first[first] == persons_id_first[second]).long()
+                    selected = get_hard_pairs(z, verification, opt.hard_negative_ratio)
+                    output, verification = (z[selected], x, y), verification[selected]
+                    persons_id_second = persons_id_first
                 else:
-                    idx = train_data.get_random_class_image_idx(persons_id_first[j].item(), False)
-                    
-                second_image = train_data[idx]
-                images_second[j] = second_image["image"]
-                persons_id_second[j] = second_image["person_id"]
-                
-
-            output = model(images_first, images_second, epoch <= opt.pretrain_classifiers_epochs)
-
+                    partner, verification = get_batch_pairs(persons_id_first, opt.num_instances)
+                    persons_id_second = persons_id_first[partner]
+                    output = model.forward_indexed(images, torch.arange(images.size(0), device = opt.device), partner,
+                                                   epoch <= opt.pretrain_classifiers_epochs)
+            else:
+                images_first = batch['image_first'].to(opt.device, non_blocking = True)
+                images_second = batch['image_second'].to(opt.device, non_blocking = True)
+                persons_id_first = batch['person_id_first'].to(opt.device, non_blocking = True)
+                persons_id_second = batch['person_id_second'].to(opt.device, non_blocking = True)
+                verification = batch['verification'].to(opt.device, non_blocking = True)
+                model.sample_classes(torch.cat((persons_id_first, persons_id_second)), opt.sampled_classes)
+                output = model(images_first, images_second, epoch <= opt.pretrain_classifiers_epochs, opt.shared_forward,
+                               batch['index_first'].to(opt.device), batch['index_second'].to(opt.device))
+
+            persons_id_first, persons_id_second = model.get_sampled_targets(persons_id_first), model.get_sampled_targets(persons_id_second)
             loss_verification = F.cross_entropy(output[0], verification)
             loss_first_id = F.cross_entropy(output[1], persons_id_first)
             loss_second_id = F.cross_entropy(output[2], persons_id_second)
@@ -0,0 +1,133 @@
+import io
+import json
+import os
+import os.path as osp
+import numpy as np
+
+
+def append_npy(path, rows):
+    """Appends rows to a saved .npy array, patching its header in place when the header length allows it"""
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_length = f.tell()
+        rows = np.asarray(rows)
+
+        if not fortran_order and rows.shape[1:] == shape[1:] and np.can_cast(rows.dtype, dtype, 'same_kind') \
+                and (rows.dtype.kind not in 'US' or rows.dtype.itemsize <= dtype.itemsize):
+            header = io.BytesIO()
+            header_dict = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (shape[0] + len(rows),) + shape[1:]}
+            if version == (1, 0):
+                np.lib.format.write_array_header_1_0(header, header_dict)
+            else:
+                np.lib.format.write_array_header_2_0(header, header_dict)
+            if len(header.getvalue()) == header_length:
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(rows, dtype = dtype).tobytes())
+                f.seek(0)
+                f.write(header.getvalue())
+                return
+
+    np.save(path, np.concatenate([np.load(path), rows]))
+
+
+def compact_npy(path, keep, chunk_size = 65536):
+    """Rewrites a saved .npy array keeping only the rows selected by the boolean mask keep"""
+    array = np.load(path, mmap_mode = 'r')
+    keep_idx = np.nonzero(keep)[0]
+    tmp_path = path + '.tmp.npy'
+    output = np.lib.format.open_memmap(tmp_path, mode = 'w+', dtype = array.dtype, shape = (len(keep_idx),) + array.shape[1:])
+    for start in range(0, len(keep_idx), chunk_size):
+        output[start:start + chunk_size] = array[keep_idx[start:start + chunk_size]]
+    output.flush()
+    del output, array
+    os.replace(tmp_path, path)
+
+
+class DescriptorStore():
+    """Descriptor matrix with aligned person and camera ids, saved as a directory of .npy files
+
+    The directory holds features.npy (float32 or float16 N x D), person_ids.npy and
+    camera_ids.npy (int32 N) and header.json describing how the descriptors were made
+    (checkpoint suffix, preprocessing). Optional extra per-row arrays (e.g. image names)
+    are saved as <name>.npy. Loading memory-maps the arrays.
+    """
+
+    def __init__(self, features, person_ids, camera_ids, header = None, extra = None):
+        self.features = features
+        self.person_ids = person_ids
+        self.camera_ids = camera_ids
+        self.header = dict(header) if header is not None else {}
+        self.extra = dict(extra) if extra is not None else {}
+
+    def __len__(self):
+        return len(self.person_ids)
+
+    def astype(self, dtype):
+        return DescriptorStore(np.asarray(self.features, dtype = dtype), self.person_ids, self.camera_ids, self.header, self.extra)
+
+    def get_arrays(self):
+        arrays = {'features': np.ascontiguousarray(self.features),
+                  'person_ids': np.asarray(self.person_ids, dtype = np.int32),
+                  'camera_ids': np.asarray(self.camera_ids, dtype = np.int32)}
+        arrays.update({key: np.asarray(value) for key, value in self.extra.items()})
+        return arrays
+
+    def save_header(self, path):
+        self.header.update({'count': len(self), 'dim': int(self.features.shape[1]), 'dtype': str(self.features.dtype),
+                            'extra': sorted(self.extra)})
+        with open(osp.join(path, 'header.json'), 'w') as f:
+            json.dump(self.header, f, indent = 4)
+
+    def save(self, path):
+        if not osp.exists(path):
+            os.makedirs(path)
+        for key, array in self.get_arrays().items():
+            np.save(osp.join(path, key + '.npy'), array)
+        self.save_header(path)
+
+    def append(self, path, other):
+        """Appends the rows of another store to this saved store and reloads it"""
+        arrays = other.astype(self.features.dtype).get_arrays()
+        if sorted(other.extra) != sorted(self.extra):
+            raise ValueError('Appended descriptors have extra arrays {}, the store has {}'.format(sorted(other.extra), sorted(self.extra)))
+        for key, rows in arrays.items():
+            append_npy(osp.join(path, key + '.npy'), rows)
+        store = DescriptorStore.load(path)
+        store.header = self.header
+        store.save_header(path)
+        return store
+
+    def compact(self, path, keep):
+        """Drops the rows of this saved store not selected by the boolean mask keep and reloads it"""
+        keys = list(self.get_arrays())
+        del self.features, self.person_ids, self.camera_ids, self.extra
+        for key in keys:
+            compact_npy(osp.join(path, key + '.npy'), keep)
+        store = DescriptorStore.load(path)
+        store.header = self.header
+        store.save_header(path)
+        return store
+
+    @staticmethod
+    def load(path, mmap_mode = 'r'):
+        with open(osp.join(path, 'header.json')) as f:
+            header = json.load(f)
+        return DescriptorStore(np.load(osp.join(path, 'features.npy'), mmap_mode = mmap_mode),
+                               np.load(osp.join(path, 'person_ids.npy'), mmap_mode = mmap_mode),
+                               np.load(osp.join(path, 'camera_ids.npy'), mmap_mode = mmap_mode),
+                               header,
+                               {key: np.load(osp.join(path, key + '.npy'), mmap_mode = mmap_mode) for key in header.get('extra', [])})
+
+
+def load_descriptor_store(path, header = None):
+    """Loads a store if it exists and was made with the given header fields, otherwise returns None"""
+    if not osp.exists(osp.join(path, 'header.json')):
+        return None
+    store = DescriptorStore.load(path)
+    if header is not None and any(store.header.get(key) != value for key, value in header.items()):
+        return None
+    return store
@@ -0,0 +1,36 @@
+import numpy as np
+from util.gallery_index import FlatIndex
+from util.similarity import normalize_descriptors
+
+
+def weighted_neighbor_sum(features, database, k, alpha = 3., self_weight = 0., memory_budget = 256 * 2 ** 20):
+    """Replaces every row of features with the weighted sum of its top-k database neighbors, L2-normalized
+
+    A neighbor with cosine similarity s gets weight max(s, 0) ** alpha (alpha = 0 gives
+    the plain average) and the row itself gets self_weight. Neighbors are found with
+    tiled top-k search and summed by gathering blocks of rows, memory stays within
+    memory_budget bytes per tile.
+    """
+    features = normalize_descriptors(features)
+    database = normalize_descriptors(database)
+    index = FlatIndex(database.shape[1], memory_budget)
+    index.add(database)
+    scores, ids = index.search(features, k)
+    weights = np.where(ids >= 0, np.maximum(scores, 0.) ** alpha, 0.).astype(np.float32)
+
+    expanded = self_weight * features
+    block_size = max(memory_budget // max(4 * ids.shape[1] * database.shape[1], 1), 1)
+    for start in range(0, len(features), block_size):
+        block = slice(start, start + block_size)
+        expanded[block] += np.einsum('nk,nkd->nd', weights[block], database[np.maximum(ids[block], 0)])
+    return normalize_descriptors(expanded)
+
+
+def query_expansion(query, gallery, k, alpha = 3., memory_budget = 256 * 2 ** 20):
+    """alpha-weighted query expansion: the query plus its top-k gallery matches"""
+    return weighted_neighbor_sum(query, gallery, k, alpha, 1., memory_budget)
+
+
+def database_augmentation(gallery, k, alpha = 3., memory_budget = 256 * 2 ** 20):
+    """Database-side augmentation: every gallery item becomes the weighted sum of its top-k gallery neighbors, itself included"""
+    return weighted_neighbor_sum(gallery, gallery, k, alpha, 0., memory_budget)
@@ -0,0 +1,86 @@
+from tqdm import tqdm
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def prepare_inference_model(model, channels_last = False):
+    """Puts a descriptor model in eval mode, converting it to channels_last memory format if asked"""
+    model.eval()
+    if channels_last:
+        model = model.to(memory_format = torch.channels_last)
+    return model
+
+
+class TestTimeAugmentation(nn.Module):
+    """Averages descriptors of several views of every image computed in one forward pass
+
+    Views are the image, its horizontal flip if flip, and for every scale in scales a
+    centered crop keeping that fraction of the height and width resized back to the
+    input size (flipped too if flip). All views are stacked along the batch dimension,
+    so the backbone sees one batch num_views times larger. The average is taken in float32.
+    """
+
+    def __init__(self, model, flip = True, scales = ()):
+        super().__init__()
+        for scale in scales:
+            if not 0 < scale <= 1:
+                raise ValueError('TTA crop scales must be in (0, 1], got {}'.format(scale))
+        self.model = model
+        self.flip = flip
+        self.scales = list(scales)
+
+    @property
+    def num_views(self):
+        return (1 + len(self.scales)) * (2 if self.flip else 1)
+
+    def get_config(self):
+        return {'flip': self.flip, 'scales': self.scales}
+
+    def get_views(self, x):
+        height, width = x.shape[2:]
+        views = [x]
+        for scale in self.scales:
+            crop_height, crop_width = max(round(height * scale), 1), max(round(width * scale), 1)
+            top, left = (height - crop_height) // 2, (width - crop_width) // 2
+            crop = x[:, :, top:top + crop_height, left:left + crop_width]
+            views.append(F.interpolate(crop, size = (height, width), mode = 'bilinear', align_corners = False))
+        if self.flip:
+            views += [view.flip(3) for view in views]
+        return torch.cat(views)
+
+    def forward(self, x):
+        output = self.model(self.get_views(x))
+        return output.reshape(self.num_views, x.size(0), *output.shape[1:]).mean(0, dtype = torch.float32)
+
+
+def embed_batch(model, images, device, channels_last = False, bf16 = False):
+    """Returns float32 B x D descriptors of a batch of preprocessed images as a numpy array"""
+    device = torch.device(device)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    with torch.no_grad(), torch.autocast(device.type, dtype = torch.bfloat16, enabled = bf16):
+        output = model(images.to(device, memory_format = memory_format))
+    return output.float().reshape(output.size(0), -1).cpu().numpy()
+
+
+def extract_descriptors(model, dataloader, device, channels_last = False, bf16 = False):
+    """Runs model over a dataloader and returns aligned (features, person ids, camera ids) arrays
+
+    With channels_last images are fed in channels_last memory format (prepare the model
+    with prepare_inference_model), with bf16 the model runs under bfloat16 autocast.
+    Descriptors are always returned as float32.
+    """
+    features = np.zeros((len(dataloader.dataset), 4096), dtype = np.float32)
+    person_ids = np.zeros(len(dataloader.dataset), dtype = np.int32)
+    camera_ids = np.zeros(len(dataloader.dataset), dtype = np.int32)
+
+    start = 0
+    for batch in tqdm(dataloader):
+        output = embed_batch(model, batch['image'], device, channels_last, bf16)
+        end = start + len(output)
+        features[start:end] = output
+        person_ids[start:end] = batch['person_id'].numpy()
+        camera_ids[start:end] = batch['camera_id'].numpy()
+        start = end
+    return features, person_ids, camera_ids
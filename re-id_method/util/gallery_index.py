@@ -0,0 +1,260 @@
+import json
+from abc import ABC, abstractmethod
+import numpy as np
+from util.similarity import normalize_descriptors, iterate_similarity_blocks
+
+
+def kmeans(data, num_clusters, num_iters = 20, spherical = False, seed = 0, block_size = 65536):
+    """Lloyd's k-means; spherical keeps unit-norm centroids and assigns by inner product"""
+    rng = np.random.default_rng(seed)
+    data = np.ascontiguousarray(data, dtype = np.float32)
+    centroids = data[rng.choice(len(data), num_clusters, replace = len(data) < num_clusters)].copy()
+
+    for _ in range(num_iters):
+        assignment = assign_clusters(data, centroids, spherical, block_size)
+        counts = np.bincount(assignment, minlength = num_clusters)
+        empty = counts == 0
+        order = np.argsort(assignment, kind = 'stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        centroids[~empty] = np.add.reduceat(data[order], starts[~empty]) / counts[~empty, None]
+        centroids[empty] = data[rng.choice(len(data), empty.sum())]
+        if spherical:
+            centroids = normalize_descriptors(centroids)
+    return centroids
+
+
+def assign_clusters(data, centroids, spherical = False, block_size = 65536):
+    """Returns the index of the nearest centroid for every row of data"""
+    if spherical:
+        bias = np.zeros(len(centroids), dtype = np.float32)
+    else:
+        bias = -0.5 * (centroids ** 2).sum(1)
+    assignment = np.zeros(len(data), dtype = np.int64)
+    for start in range(0, len(data), block_size):
+        assignment[start:start + block_size] = (data[start:start + block_size] @ centroids.T + bias).argmax(1)
+    return assignment
+
+
+def select_topk(scores, ids, k):
+    """Returns the k best (scores, ids) of every row sorted by decreasing score"""
+    k = min(k, scores.shape[1])
+    rows = np.arange(len(scores))[:, None]
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis = 1)[:, :k]
+        scores, ids = scores[rows, part], ids[rows, part]
+    order = np.argsort(-scores, axis = 1, kind = 'stable')
+    return scores[rows, order], ids[rows, order]
+
+
+class GalleryIndex(ABC):
+    """Base class of gallery indices over L2-normalized descriptors
+
+    Subclasses implement train, add, search and describe themselves with
+    get_config / get_arrays / set_arrays, which save and load_gallery_index use.
+    search returns Q x k scores and ids, padded with -inf and -1 where fewer than k
+    gallery descriptors were found.
+    """
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def train(self, features):
+        pass
+
+    @abstractmethod
+    def add(self, features, ids = None):
+        pass
+
+    @abstractmethod
+    def search(self, query, k):
+        pass
+
+    @abstractmethod
+    def get_config(self):
+        pass
+
+    @abstractmethod
+    def get_arrays(self):
+        pass
+
+    @abstractmethod
+    def set_arrays(self, arrays):
+        pass
+
+    def save(self, path):
+        np.savez(path, config = np.array(json.dumps(self.get_config())), **self.get_arrays())
+
+
+class FlatIndex(GalleryIndex):
+    """Exact inner product search"""
+
+    def __init__(self, dim, memory_budget = 256 * 2 ** 20):
+        self.dim = dim
+        self.memory_budget = memory_budget
+        self.features = np.zeros((0, dim), dtype = np.float32)
+        self.ids = np.zeros(0, dtype = np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def train(self, features):
+        pass
+
+    def add(self, features, ids = None):
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(features))
+        self.features = np.concatenate([self.features, normalize_descriptors(features)])
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype = np.int64)])
+
+    def search(self, query, k):
+        """Returns Q x k scores and gallery ids (-1 where the gallery is smaller than k)"""
+        query = normalize_descriptors(query)
+        scores = np.full((len(query), k), -np.inf, dtype = np.float32)
+        ids = np.full((len(query), k), -1, dtype = np.int64)
+        for q_slice, g_slice, block in iterate_similarity_blocks(query, self.features, self.memory_budget):
+            scores[q_slice], ids[q_slice] = select_topk(np.concatenate([scores[q_slice], block], 1),
+                                                        np.concatenate([ids[q_slice], np.broadcast_to(self.ids[g_slice], block.shape)], 1), k)
+        return scores, ids
+
+    def get_config(self):
+        return {'type': 'flat', 'dim': self.dim}
+
+    def get_arrays(self):
+        return {'features': self.features, 'ids': self.ids}
+
+    def set_arrays(self, arrays):
+        self.features, self.ids = arrays['features'], arrays['ids']
+
+
+class IVFIndex(GalleryIndex):
+    """Inverted file index: spherical k-means coarse quantizer plus inverted lists
+
+    With pq_m > 0 the residuals to the coarse centroids are product-quantized into
+    pq_m bytes per descriptor and scored with per-query lookup tables, otherwise the
+    inverted lists hold full float32 descriptors.
+    """
+
+    def __init__(self, dim, nlist = 1024, nprobe = 16, pq_m = 0, kmeans_iters = 20, max_train_points = 256, seed = 0):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.kmeans_iters = kmeans_iters
+        self.max_train_points = max_train_points
+        self.seed = seed
+        if pq_m > 0 and dim % pq_m != 0:
+            raise ValueError('Descriptor dimension {} is not divisible by pq_m {}'.format(dim, pq_m))
+
+        self.centroids = None
+        self.codebooks = None
+        self.list_offsets = np.zeros(nlist + 1, dtype = np.int64)
+        self.list_ids = np.zeros(0, dtype = np.int64)
+        self.list_data = np.zeros((0, pq_m), dtype = np.uint8) if pq_m > 0 else np.zeros((0, dim), dtype = np.float32)
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    def train(self, features):
+        """Fits the quantizers on at most max_train_points descriptors per coarse centroid"""
+        rng = np.random.default_rng(self.seed)
+        if len(features) > self.max_train_points * self.nlist:
+            features = features[np.sort(rng.choice(len(features), self.max_train_points * self.nlist, replace = False))]
+        features = normalize_descriptors(features)
+        self.centroids = kmeans(features, self.nlist, self.kmeans_iters, spherical = True, seed = self.seed)
+        if self.pq_m > 0:
+            residuals = features - self.centroids[assign_clusters(features, self.centroids, spherical = True)]
+            sub_dim = self.dim // self.pq_m
+            self.codebooks = np.stack([kmeans(residuals[:, m * sub_dim:(m + 1) * sub_dim], 256, self.kmeans_iters, seed = self.seed + m)
+                                       for m in range(self.pq_m)])
+
+    def encode(self, features, lists):
+        residuals = features - self.centroids[lists]
+        sub_dim = self.dim // self.pq_m
+        return np.stack([assign_clusters(residuals[:, m * sub_dim:(m + 1) * sub_dim], self.codebooks[m])
+                         for m in range(self.pq_m)], 1).astype(np.uint8)
+
+    def add(self, features, ids = None):
+        if self.centroids is None:
+            raise RuntimeError('IVFIndex has to be trained before adding descriptors')
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(features))
+        features = normalize_descriptors(features)
+        lists = assign_clusters(features, self.centroids, spherical = True)
+        data = self.encode(features, lists) if self.pq_m > 0 else features
+
+        old_lists = np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+        all_lists = np.concatenate([old_lists, lists])
+        order = np.argsort(all_lists, kind = 'stable')
+        self.list_ids = np.concatenate([self.list_ids, np.asarray(ids, dtype = np.int64)])[order]
+        self.list_data = np.concatenate([self.list_data, data])[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(all_lists, minlength = self.nlist))])
+
+    def search(self, query, k, nprobe = None):
+        """Returns Q x k approximate scores and gallery ids (-1 where fewer candidates were probed)"""
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.nlist)
+        query = normalize_descriptors(query)
+        coarse = query @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis = 1)[:, :nprobe]
+        if self.pq_m > 0:
+            sub_dim = self.dim // self.pq_m
+            tables = np.einsum('qmd,mcd->qmc', query.reshape(len(query), self.pq_m, sub_dim), self.codebooks)
+
+        scores = np.full((len(query), k), -np.inf, dtype = np.float32)
+        ids = np.full((len(query), k), -1, dtype = np.int64)
+
+        # every inverted list is scored once against all queries probing it
+        probed_lists = probes.ravel()
+        order = np.argsort(probed_lists, kind = 'stable')
+        probing_queries = np.repeat(np.arange(len(query)), nprobe)[order]
+        bounds = np.searchsorted(probed_lists[order], np.arange(self.nlist + 1))
+        for l in range(self.nlist):
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == end or bounds[l] == bounds[l + 1]:
+                continue
+            qs = probing_queries[bounds[l]:bounds[l + 1]]
+            if self.pq_m > 0:
+                codes = self.list_data[start:end]
+                block = np.repeat(coarse[qs, l][:, None], end - start, 1)
+                for m in range(self.pq_m):
+                    block += tables[qs, m][:, codes[:, m]]
+            else:
+                block = query[qs] @ self.list_data[start:end].T
+            scores[qs], ids[qs] = select_topk(np.concatenate([scores[qs], block], 1),
+                                              np.concatenate([ids[qs], np.broadcast_to(self.list_ids[start:end], block.shape)], 1), k)
+        return scores, ids
+
+    def get_config(self):
+        return {'type': 'ivf', 'dim': self.dim, 'nlist': self.nlist, 'nprobe': self.nprobe, 'pq_m': self.pq_m,
+                'kmeans_iters': self.kmeans_iters, 'max_train_points': self.max_train_points, 'seed': self.seed}
+
+    def get_arrays(self):
+        arrays = {'centroids': self.centroids, 'list_offsets': self.list_offsets, 'list_ids': self.list_ids, 'list_data': self.list_data}
+        if self.pq_m > 0:
+            arrays['codebooks'] = self.codebooks
+        return arrays
+
+    def set_arrays(self, arrays):
+        self.centroids = arrays['centroids']
+        self.codebooks = arrays['codebooks'] if self.pq_m > 0 else None
+        self.list_offsets, self.list_ids, self.list_data = arrays['list_offsets'], arrays['list_ids'], arrays['list_data']
+
+
+index_types = {'flat': FlatIndex, 'ivf': IVFIndex}
+
+
+def get_gallery_index(index_type, dim, **kwargs):
+    """Creates an empty gallery index of the given type ('flat' or 'ivf')"""
+    if index_type not in index_types:
+        raise ValueError('Unknown gallery index type {}'.format(index_type))
+    return index_types[index_type](dim, **kwargs)
+
+
+def load_gallery_index(path):
+    arrays = np.load(path)
+    config = json.loads(str(arrays['config']))
+    index_type = config.pop('type')
+    index = get_gallery_index(index_type, **config)
+    index.set_arrays({key: arrays[key] for key in arrays.files if key != 'config'})
+    return index
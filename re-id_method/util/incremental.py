@@ -0,0 +1,65 @@
+import os
+import numpy as np
+from util.descriptor_store import DescriptorStore, load_descriptor_store
+
+
+def scan_images(root_dir):
+    """Returns sorted image names of a folder with their modification times (ns) and sizes"""
+    entries = sorted((entry.name, entry.stat()) for entry in os.scandir(root_dir) if entry.is_file())
+    names = np.array([name for name, _ in entries], dtype = str)
+    mtimes = np.array([stat.st_mtime_ns for _, stat in entries], dtype = np.int64)
+    sizes = np.array([stat.st_size for _, stat in entries], dtype = np.int64)
+    return names, mtimes, sizes
+
+
+def get_file_signature(path):
+    """Returns [modification time (ns), size] of a file, None if it does not exist"""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def refresh_descriptor_store(path, root_dir, header, embed_images, rebuild = False):
+    """Brings the descriptor store at path up to date with the images of root_dir
+
+    Images are keyed by file name, modification time and size. Only added or changed
+    images are embedded and appended to the store, deleted or changed ones are dropped.
+    The whole folder is embedded again if the store is missing or its header (checkpoint
+    suffix and file signature, preprocessing, dtype) differs.
+
+    Parameters:
+        path (str)               -- directory of the descriptor store
+        root_dir (str)           -- folder with images
+        header (dict)            -- header fields the store has to match
+        embed_images (function)  -- maps a list of image names to (features, person ids, camera ids)
+        rebuild (bool)           -- embed the whole folder even if the store is up to date
+
+    Returns the store and the numbers of added and removed images.
+    """
+    names, mtimes, sizes = scan_images(root_dir)
+    store = load_descriptor_store(path, header) if not rebuild else None
+    if store is not None and not all(key in store.extra for key in ['image_names', 'mtimes', 'sizes']):
+        store = None
+
+    if store is None:
+        store = DescriptorStore(*embed_images(list(names)), header = header, extra = {'image_names': names, 'mtimes': mtimes, 'sizes': sizes})
+        store = store.astype(header['dtype']) if 'dtype' in header else store
+        store.save(path)
+        return DescriptorStore.load(path), len(names), 0
+
+    # a changed image counts as removed and added again
+    current = {name: (mtime, size) for name, mtime, size in zip(names, mtimes, sizes)}
+    keep = np.array([current.get(name) == (mtime, size) for name, mtime, size
+                     in zip(store.extra['image_names'], store.extra['mtimes'], store.extra['sizes'])], dtype = bool)
+    stored = set(np.asarray(store.extra['image_names'])[keep])
+    added = np.array([name not in stored for name in names], dtype = bool)
+
+    num_removed = int((~keep).sum())
+    if num_removed > 0:
+        store = store.compact(path, keep)
+    if added.any():
+        new_rows = DescriptorStore(*embed_images(list(names[added])),
+                                   extra = {'image_names': names[added], 'mtimes': mtimes[added], 'sizes': sizes[added]})
+        store = store.append(path, new_rows)
+    return store, int(added.sum()), num_removed
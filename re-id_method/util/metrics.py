@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def get_junk_mask(query_ids, query_cams, gallery_ids, gallery_cams, cross_camera = True):
+    """Returns the Q x G mask of gallery images excluded from the ranking of each query"""
+    junk = query_cams[:, None] == gallery_cams[None, :]
+    if not cross_camera:
+        junk &= query_ids[:, None] == gallery_ids[None, :]
+    return junk
+
+
+def evaluate(scores, query_ids, query_cams, gallery_ids, gallery_cams, max_rank = 50, cross_camera = True, chunk_size = 256):
+    """Computes CMC curve, mAP and mINP from a Q x G similarity matrix
+
+    Every row is argsorted once; queries are processed in chunks of chunk_size rows
+    so that memory stays bounded by chunk_size x G. Queries without a valid match
+    in the gallery are skipped.
+
+    Parameters:
+        scores (array)        -- Q x G similarities, higher is more similar
+        query_ids (array)     -- Q person ids of queries
+        query_cams (array)    -- Q camera ids of queries
+        gallery_ids (array)   -- G person ids of gallery images
+        gallery_cams (array)  -- G camera ids of gallery images
+        max_rank (int)        -- length of the returned CMC curve
+        cross_camera (bool)   -- discard every same-camera gallery image, otherwise only
+                                 same-person same-camera ones (Market-1501 protocol)
+        chunk_size (int)      -- number of queries processed at once
+    """
+    query_ids, query_cams = np.asarray(query_ids), np.asarray(query_cams)
+    gallery_ids, gallery_cams = np.asarray(gallery_ids), np.asarray(gallery_cams)
+    max_rank = min(max_rank, len(gallery_ids))
+
+    cmc = np.zeros(max_rank)
+    ap_sum = 0.
+    inp_sum = 0.
+    num_valid = 0
+
+    for start in range(0, len(query_ids), chunk_size):
+        end = min(start + chunk_size, len(query_ids))
+        order = np.argsort(-np.asarray(scores[start:end], dtype = np.float32), axis = 1, kind = 'stable')
+
+        matches = gallery_ids[order] == query_ids[start:end, None]
+        junk = gallery_cams[order] == query_cams[start:end, None]
+        if not cross_camera:
+            junk &= matches
+        keep = ~junk
+        matches &= keep
+
+        num_pos = matches.sum(1)
+        valid = num_pos > 0
+        if not valid.any():
+            continue
+        matches, keep, num_pos = matches[valid], keep[valid], num_pos[valid]
+
+        rank = np.cumsum(keep, 1) - 1
+        rows = np.arange(len(matches))
+        first_rank = rank[rows, matches.argmax(1)]
+        last_rank = rank[rows, matches.shape[1] - 1 - matches[:, ::-1].argmax(1)]
+
+        cmc += (first_rank[:, None] <= np.arange(max_rank)[None, :]).sum(0)
+        precision = np.cumsum(matches, 1) / np.maximum(rank + 1., 1.)
+        ap_sum += ((precision * matches).sum(1) / num_pos).sum()
+        inp_sum += (num_pos / (last_rank + 1.)).sum()
+        num_valid += len(matches)
+
+    if num_valid == 0:
+        raise RuntimeError('No query has a valid match in the gallery')
+
+    return cmc / num_valid, ap_sum / num_valid, inp_sum / num_valid
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os.path as osp
+import numpy as np
+from util.similarity import normalize_descriptors
+
+
+class DescriptorProjection():
+    """Linear projection of descriptors to fewer dimensions, fitted with PCA
+
+    Maps x to (x - mean) @ matrix. The columns of matrix are the leading principal
+    directions, divided by the square root of their variance if whitened. Projected
+    descriptors can be L2-normalized.
+    """
+
+    def __init__(self, mean, matrix, whiten = False, l2 = False):
+        self.mean = np.asarray(mean, dtype = np.float32)
+        self.matrix = np.ascontiguousarray(matrix, dtype = np.float32)
+        self.whiten = whiten
+        self.l2 = l2
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def apply(self, features, chunk_size = 65536):
+        projected = np.zeros((len(features), self.dim), dtype = np.float32)
+        for start in range(0, len(features), chunk_size):
+            chunk = np.asarray(features[start:start + chunk_size], dtype = np.float32).reshape(-1, len(self.mean))
+            projected[start:start + chunk_size] = (chunk - self.mean) @ self.matrix
+        return normalize_descriptors(projected) if self.l2 else projected
+
+    def get_config(self):
+        checksum = hashlib.md5(self.matrix.tobytes() + self.mean.tobytes()).hexdigest()[:16]
+        return {'dim': self.dim, 'whiten': self.whiten, 'l2': self.l2, 'checksum': checksum}
+
+    def save(self, path):
+        config = self.get_config()
+        np.savez(path, config = np.array(json.dumps(config)), mean = self.mean, matrix = self.matrix)
+
+    @staticmethod
+    def load(path):
+        arrays = np.load(path)
+        config = json.loads(str(arrays['config']))
+        return DescriptorProjection(arrays['mean'], arrays['matrix'], config['whiten'], config['l2'])
+
+
+def fit_projection(features, dim, whiten = False, l2 = False, eps = 1e-6, chunk_size = 65536):
+    """Fits a PCA projection of descriptors to dim dimensions
+
+    The covariance is accumulated in float64 over chunks of rows. eps, relative to the
+    largest eigenvalue, keeps whitening of low-variance directions bounded.
+    """
+    num_features = len(features)
+    mean = np.zeros(features.shape[1], dtype = np.float64)
+    for start in range(0, num_features, chunk_size):
+        mean += np.asarray(features[start:start + chunk_size], dtype = np.float64).sum(0)
+    mean /= num_features
+
+    covariance = np.zeros((features.shape[1], features.shape[1]), dtype = np.float64)
+    for start in range(0, num_features, chunk_size):
+        chunk = np.asarray(features[start:start + chunk_size], dtype = np.float64) - mean
+        covariance += chunk.T @ chunk
+    covariance /= max(num_features - 1, 1)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1][:dim]
+    eigenvalues, matrix = np.maximum(eigenvalues[order], 0), eigenvectors[:, order]
+    if whiten:
+        matrix = matrix / np.sqrt(eigenvalues + eps * eigenvalues[0])
+    return DescriptorProjection(mean, matrix, whiten, l2)
+
+
+def get_projection_path(load_path, suffix = 'latest'):
+    return osp.join(load_path, 'projection_{}.npz'.format(suffix))
+
+
+def load_projection(load_path, suffix = 'latest'):
+    """Loads the projection saved alongside a checkpoint, None if there is none"""
+    path = get_projection_path(load_path, suffix)
+    return DescriptorProjection.load(path) if osp.exists(path) else None
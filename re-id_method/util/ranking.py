@@ -0,0 +1,114 @@
+import numpy as np
+from util.metrics import get_junk_mask
+from util.similarity import normalize_descriptors, get_block_sizes
+
+
+def get_positive_candidates(query_ids, gallery_order, sorted_gallery_ids):
+    """Returns Q x P gallery indices sharing the query person id and the mask of real (non-padding) entries"""
+    starts = np.searchsorted(sorted_gallery_ids, query_ids, side = 'left')
+    counts = np.searchsorted(sorted_gallery_ids, query_ids, side = 'right') - starts
+    width = np.arange(max(counts.max(), 1))
+    mask = width[None, :] < counts[:, None]
+    candidates = gallery_order[np.minimum(starts[:, None] + width[None, :], len(gallery_order) - 1)]
+    return candidates, mask
+
+
+def count_greater(block, thresholds):
+    """For every row counts the block entries strictly greater than each of the row thresholds
+
+    Scores are cosine similarities, so rows are shifted apart by a constant offset
+    and a single searchsorted over the flattened sorted block serves all rows.
+    """
+    rows, width = block.shape
+    offsets = 8. * np.arange(rows)[:, None]
+    flat = (np.sort(np.maximum(block, -3.), axis = 1) + offsets).ravel()
+    positions = np.searchsorted(flat, (np.minimum(thresholds, 2.) + offsets).ravel(), side = 'right')
+    return width * (np.arange(rows)[:, None] + 1) - positions.reshape(thresholds.shape)
+
+
+def topk_ranking(query, gallery, query_ids, query_cams, gallery_ids, gallery_cams, k = 100, max_rank = 50,
+                 cross_camera = True, memory_budget = 256 * 2 ** 20):
+    """Streams gallery blocks keeping only the k best matches of every query
+
+    The exact rank of every true positive is accumulated from running counts of
+    gallery images scoring above it, so CMC, mAP and mINP are exact even for
+    positives outside the top-k.
+
+    Returns (Q x k int32 gallery indices, Q x k float16 scores, cmc, mAP, mINP).
+    """
+    query_ids, query_cams = np.asarray(query_ids), np.asarray(query_cams)
+    gallery_ids, gallery_cams = np.asarray(gallery_ids), np.asarray(gallery_cams)
+    query = normalize_descriptors(query)
+    gallery = normalize_descriptors(gallery)
+    k = min(k, len(gallery))
+    max_rank = min(max_rank, len(gallery))
+
+    gallery_order = np.argsort(gallery_ids, kind = 'stable')
+    sorted_gallery_ids = gallery_ids[gallery_order]
+
+    top_indices = np.zeros((len(query), k), dtype = np.int32)
+    top_scores = np.zeros((len(query), k), dtype = np.float16)
+    cmc = np.zeros(max_rank)
+    ap_sum = 0.
+    inp_sum = 0.
+    num_valid = 0
+
+    query_block, gallery_block = get_block_sizes(len(query), len(gallery), memory_budget)
+    for q_start in range(0, len(query), query_block):
+        q_slice = slice(q_start, min(q_start + query_block, len(query)))
+        rows = np.arange(q_slice.stop - q_slice.start)
+
+        positives, positive_mask = get_positive_candidates(query_ids[q_slice], gallery_order, sorted_gallery_ids)
+        positive_mask &= gallery_cams[positives] != query_cams[q_slice, None]
+        positive_scores = np.stack([(query[q_slice] * gallery[positives[:, p]]).sum(1) for p in range(positives.shape[1])], 1)
+        positive_scores[~positive_mask] = np.inf
+        greater = np.zeros(positive_scores.shape, dtype = np.int64)
+
+        best_scores = np.full((len(rows), 0), -np.inf, dtype = np.float32)
+        best_indices = np.zeros((len(rows), 0), dtype = np.int64)
+        for g_start in range(0, len(gallery), gallery_block):
+            g_slice = slice(g_start, min(g_start + gallery_block, len(gallery)))
+            block = query[q_slice] @ gallery[g_slice].T
+            block[get_junk_mask(query_ids[q_slice], query_cams[q_slice], gallery_ids[g_slice], gallery_cams[g_slice], cross_camera)] = -np.inf
+
+            # positives take the scores their ranks are measured against
+            in_block = positive_mask & (positives >= g_slice.start) & (positives < g_slice.stop)
+            block[np.nonzero(in_block)[0], positives[in_block] - g_slice.start] = positive_scores[in_block]
+            greater += count_greater(block, positive_scores)
+
+            candidate_scores = np.concatenate([best_scores, block], 1)
+            candidate_indices = np.concatenate([best_indices, np.broadcast_to(np.arange(g_slice.start, g_slice.stop), block.shape)], 1)
+            if candidate_scores.shape[1] > k:
+                part = np.argpartition(-candidate_scores, k - 1, axis = 1)[:, :k]
+                candidate_scores = candidate_scores[rows[:, None], part]
+                candidate_indices = candidate_indices[rows[:, None], part]
+            best_scores, best_indices = candidate_scores, candidate_indices
+
+        order = np.argsort(-best_scores, axis = 1, kind = 'stable')
+        top_indices[q_slice] = best_indices[rows[:, None], order]
+        top_scores[q_slice] = best_scores[rows[:, None], order]
+
+        num_pos = positive_mask.sum(1)
+        valid = num_pos > 0
+        ranks = np.sort(np.where(positive_mask, greater, np.iinfo(np.int64).max), axis = 1)[valid]
+        num_pos = num_pos[valid]
+        if len(num_pos) == 0:
+            continue
+
+        # positives with tied scores still occupy consecutive ranks
+        position = np.arange(ranks.shape[1])
+        ranks = np.where(position[None, :] < num_pos[:, None], ranks, 0)
+        ranks = np.maximum.accumulate(ranks - position[None, :], axis = 1) + position[None, :]
+        first_rank = ranks[:, 0]
+        last_rank = ranks[np.arange(len(ranks)), num_pos - 1]
+
+        cmc += (first_rank[:, None] <= np.arange(max_rank)[None, :]).sum(0)
+        precision = (position[None, :] + 1.) / (ranks + 1.)
+        ap_sum += (np.where(position[None, :] < num_pos[:, None], precision, 0.).sum(1) / num_pos).sum()
+        inp_sum += (num_pos / (last_rank + 1.)).sum()
+        num_valid += len(num_pos)
+
+    if num_valid == 0:
+        raise RuntimeError('No query has a valid match in the gallery')
+
+    return top_indices, top_scores, cmc / num_valid, ap_sum / num_valid, inp_sum / num_valid
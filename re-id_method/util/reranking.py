@@ -0,0 +1,155 @@
+import numpy as np
+from util.gallery_index import FlatIndex
+from util.similarity import normalize_descriptors, get_block_sizes
+
+
+def get_reciprocal_mask(neighbors):
+    """Marks the entries j of every row i of N x K neighbor lists whose own list contains i"""
+    num_rows = len(neighbors)
+    rows = np.arange(num_rows, dtype = np.int64)[:, None]
+    keys = np.sort((rows * num_rows + neighbors).ravel())
+    reverse = (neighbors.astype(np.int64) * num_rows + rows).ravel()
+    positions = np.minimum(np.searchsorted(keys, reverse), len(keys) - 1)
+    return (keys[positions] == reverse).reshape(neighbors.shape)
+
+
+def unique_rows(values, pad = -1):
+    """Sorts every row and replaces repeated entries with pad, which ends up first"""
+    values = np.sort(values, axis = 1)
+    repeated = np.zeros(values.shape, dtype = bool)
+    repeated[:, 1:] = values[:, 1:] == values[:, :-1]
+    values[repeated] = pad
+    return np.sort(values, axis = 1)
+
+
+def gather_csr_rows(indptr, indices, values, rows):
+    """Returns (position of the requested row, column, value) of all entries of the given CSR rows"""
+    lengths = indptr[rows + 1] - indptr[rows]
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    entries = np.repeat(indptr[rows], lengths) + offsets
+    return owner, indices[entries], values[entries]
+
+
+def sum_duplicates(rows, cols, values, num_cols):
+    """Sums values of repeated (row, col) pairs; returns the unique pairs sorted by row and column"""
+    keys = rows.astype(np.int64) * num_cols + cols
+    unique, inverse = np.unique(keys, return_inverse = True)
+    return unique // num_cols, unique % num_cols, np.bincount(inverse, weights = values).astype(np.float32)
+
+
+class RerankedScores():
+    """Q x G similarities after k-reciprocal re-ranking, computed on slicing a block of queries
+
+    Follows Zhong et al., "Re-ranking Person Re-identification with k-reciprocal
+    Encoding": every query and gallery descriptor is encoded by exp(-distance)
+    weights over its expanded k1-reciprocal neighbors, averaged over its k2 nearest
+    neighbors, and the final distance mixes the Jaccard distance of the encodings
+    with the original one, distance = (1 - lambda_value) * jaccard + lambda_value * (1 - cosine).
+
+    Only top-k neighbor lists and the sparse encodings are kept, so memory grows
+    as (Q + G) * k; slicing rows of queries builds just that Q_block x G tile.
+    Re-ranked scores are negated distances, higher is more similar, so they can be
+    passed to evaluate with chunk_size = block_size.
+    """
+
+    def __init__(self, query, gallery, k1 = 20, k2 = 6, lambda_value = 0.3, memory_budget = 256 * 2 ** 20):
+        self.query = normalize_descriptors(query)
+        self.gallery = normalize_descriptors(gallery)
+        self.lambda_value = lambda_value
+        self.memory_budget = memory_budget
+        self.block_size = get_block_sizes(len(self.query), len(self.gallery), memory_budget)[0]
+
+        features = np.concatenate([self.query, self.gallery])
+        index = FlatIndex(features.shape[1], memory_budget)
+        index.add(features)
+        k1 = min(k1, len(features) - 1)
+        neighbors = index.search(features, k1 + 1)[1]
+
+        indptr, indices, values = self.encode(features, neighbors, k1)
+        if k2 > 1:
+            indptr, indices, values = self.expand_query(indptr, indices, values, neighbors[:, :k2])
+
+        # gallery encodings by column, to find the galleries sharing a neighbor with a query
+        num_query = len(self.query)
+        self.query_csr = indptr[:num_query + 1], indices[:indptr[num_query]], values[:indptr[num_query]]
+        gallery_rows = np.repeat(np.arange(len(self.gallery)), np.diff(indptr[num_query:]))
+        gallery_cols, gallery_values = indices[indptr[num_query]:], values[indptr[num_query]:]
+        order = np.argsort(gallery_cols, kind = 'stable')
+        self.gallery_csc = (np.concatenate([[0], np.cumsum(np.bincount(gallery_cols, minlength = len(features)))]),
+                            gallery_rows[order], gallery_values[order])
+
+    def encode(self, features, neighbors, k1):
+        """Returns CSR weights of every descriptor over its expanded k1-reciprocal neighbors"""
+        num_half = int(np.around(k1 / 2.)) + 1
+        reciprocal = np.where(get_reciprocal_mask(neighbors), neighbors, -1)
+        half = np.where(get_reciprocal_mask(neighbors[:, :num_half]), neighbors[:, :num_half], -1)
+        num_rows = len(features)
+
+        block_size = max(self.memory_budget // (8 * (k1 + 1) * (num_half + 1) * 4), 1)
+        counts, cols, values = [], [], []
+        for start in range(0, num_rows, block_size):
+            rows = np.arange(start, min(start + block_size, num_rows))
+            candidates = reciprocal[rows]
+            halves = np.where(candidates[:, :, None] >= 0, half[np.maximum(candidates, 0)], -1)
+
+            # a candidate adds its half-size reciprocal set if more than 2/3 of it is already in the set
+            keys = np.sort(np.where(candidates >= 0, rows[:, None] * num_rows + candidates, -1).ravel())
+            queries = rows[:, None, None] * num_rows + halves
+            positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+            overlap = ((keys[positions] == queries) & (halves >= 0)).sum(2)
+            accepted = overlap > 2. / 3. * (halves >= 0).sum(2)
+            expanded = np.concatenate([candidates, np.where(accepted[:, :, None], halves, -1).reshape(len(rows), -1)], 1)
+            expanded = unique_rows(expanded)
+
+            weights = np.zeros(expanded.shape, dtype = np.float32)
+            for column in range(expanded.shape[1]):
+                valid = expanded[:, column] >= 0
+                if valid.any():
+                    similarity = (features[rows[valid]] * features[expanded[valid, column]]).sum(1)
+                    weights[valid, column] = np.exp(similarity - 1.)
+            weights /= np.maximum(weights.sum(1, keepdims = True), 1e-12)
+            counts.append((expanded >= 0).sum(1))
+            cols.append(expanded[expanded >= 0])
+            values.append(weights[expanded >= 0])
+
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+        return indptr, np.concatenate(cols), np.concatenate(values)
+
+    def expand_query(self, indptr, indices, values, neighbors):
+        """Replaces every encoding with the mean encoding of its nearest neighbors"""
+        num_rows = len(indptr) - 1
+        rows, cols, sums = [], [], []
+        for start in range(0, num_rows, self.block_size):
+            block = neighbors[start:start + self.block_size]
+            owner, block_cols, block_values = gather_csr_rows(indptr, indices, values, block.ravel())
+            block_rows, block_cols, block_sums = sum_duplicates(owner // block.shape[1] + start, block_cols, block_values, num_rows)
+            rows.append(block_rows)
+            cols.append(block_cols)
+            sums.append(block_sums / block.shape[1])
+        rows = np.concatenate(rows)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength = num_rows))])
+        return indptr, np.concatenate(cols), np.concatenate(sums)
+
+    def __len__(self):
+        return len(self.query)
+
+    @property
+    def shape(self):
+        return len(self.query), len(self.gallery)
+
+    def __getitem__(self, rows):
+        rows = np.arange(len(self.query))[rows]
+        distance = 1. - self.query[rows] @ self.gallery.T
+        jaccard = np.ones(distance.shape, dtype = np.float32)
+
+        # overlap of two encodings = sum of minimal weights over shared neighbors
+        owner, cols, query_values = gather_csr_rows(*self.query_csr, rows)
+        colptr, gallery_rows, gallery_values = self.gallery_csc
+        pair_owner, gallery_idx, pair_values = gather_csr_rows(colptr, gallery_rows, gallery_values, cols)
+        if len(pair_owner) > 0:
+            minimum = np.minimum(query_values[pair_owner], pair_values)
+            block_rows, block_cols, overlap = sum_duplicates(owner[pair_owner], gallery_idx, minimum, len(self.gallery))
+            # encodings sum to one, so the sum of maxima is 2 - overlap
+            jaccard[block_rows, block_cols] = 1. - overlap / (2. - overlap)
+        return -((1. - self.lambda_value) * jaccard + self.lambda_value * distance)
@@ -0,0 +1,160 @@
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+import numpy as np
+import torch
+from util.gallery_index import FlatIndex
+
+
+class LatencyHistogram():
+    """Thread-safe histogram of latencies over fixed buckets in milliseconds
+
+    Percentiles are reported as the upper bound of the bucket they fall into.
+    """
+
+    BOUNDS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.BOUNDS), dtype = np.int64)
+        self.total = 0.
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        milliseconds = seconds * 1000
+        with self.lock:
+            self.counts[np.searchsorted(self.BOUNDS, milliseconds)] += 1
+            self.total += milliseconds
+
+    def snapshot(self):
+        with self.lock:
+            counts, total = self.counts.copy(), self.total
+        num = int(counts.sum())
+        result = {'count': num, 'mean_ms': total / num if num > 0 else 0.,
+                  'buckets': {'<={}ms'.format(bound): int(count) for bound, count in zip(self.BOUNDS, counts)}}
+        for percentile in [50, 90, 99]:
+            position = np.searchsorted(np.cumsum(counts), percentile / 100 * num) if num > 0 else 0
+            result['p{}_ms'.format(percentile)] = self.BOUNDS[min(position, len(self.BOUNDS) - 1)] if num > 0 else 0.
+        return result
+
+
+class MicroBatcher():
+    """Collects concurrently submitted image batches into micro-batches for one embedding function
+
+    A collector thread takes the first waiting request, then keeps adding requests
+    until max_batch_size images are collected or max_wait seconds have passed, and
+    hands the micro-batch to a pool of num_workers threads. While all workers are busy
+    the collector blocks, so requests keep queueing and the next micro-batch grows.
+    A request larger than max_batch_size runs as a micro-batch of its own.
+    """
+
+    def __init__(self, embed, max_batch_size = 32, max_wait = 0.005, num_workers = 1):
+        self.embed = embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.pool = ThreadPoolExecutor(num_workers)
+        self.slots = threading.Semaphore(num_workers)
+        self.histograms = {'queue_wait': LatencyHistogram(), 'inference': LatencyHistogram()}
+        self.batch_sizes = Counter()
+        self.lock = threading.Lock()
+        self.collector = threading.Thread(target = self.collect, daemon = True)
+        self.collector.start()
+
+    def submit(self, images):
+        """Queues an N x C x H x W image tensor, returns a Future of its N x D descriptors"""
+        future = Future()
+        self.requests.put((images, future, time()))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.collector.join()
+        self.pool.shutdown()
+
+    def collect(self):
+        carry, closing = None, False
+        while not closing:
+            request = carry if carry is not None else self.requests.get()
+            carry = None
+            if request is None:
+                break
+            batch, size, deadline = [request], len(request[0]), time() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout = max(deadline - time(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    carry = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self.slots.acquire()
+            self.pool.submit(self.run, batch)
+
+    def run(self, batch):
+        try:
+            start = time()
+            for _, _, submitted in batch:
+                self.histograms['queue_wait'].observe(start - submitted)
+            images = batch[0][0] if len(batch) == 1 else torch.cat([images for images, _, _ in batch])
+            features = self.embed(images)
+            self.histograms['inference'].observe(time() - start)
+            with self.lock:
+                self.batch_sizes[len(images)] += 1
+            offsets = np.cumsum([0] + [len(images) for images, _, _ in batch])
+            for (_, future, _), begin, end in zip(batch, offsets[:-1], offsets[1:]):
+                future.set_result(features[begin:end])
+        except Exception as error:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            self.slots.release()
+
+    def get_metrics(self):
+        with self.lock:
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+        return {'batch_sizes': {str(size): count for size, count in batch_sizes.items()},
+                **{name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+
+class EmbeddingService():
+    """Embeds preprocessed crops through a MicroBatcher and matches them against an optional gallery
+
+    gallery is a DescriptorStore (e.g. gallery_descriptors_<suffix> of test.py) whose
+    descriptors were made by the same model and projection. Request latencies, from
+    submission to the returned matches, are kept in a histogram.
+    """
+
+    def __init__(self, batcher, gallery = None, memory_budget = 256 * 2 ** 20):
+        self.batcher = batcher
+        self.gallery = gallery
+        self.index = None
+        if gallery is not None:
+            self.index = FlatIndex(gallery.features.shape[1], memory_budget)
+            self.index.add(gallery.features)
+        self.request_latency = LatencyHistogram()
+
+    def embed(self, images, top_k = 0):
+        """Returns (N x D descriptors, top-k matches of every crop as lists of dicts or None)"""
+        start = time()
+        features = self.batcher.submit(images).result()
+        matches = None
+        if top_k > 0 and self.index is not None:
+            scores, ids = self.index.search(features, top_k)
+            names = self.gallery.extra.get('image_names')
+            matches = [[{'index': int(i), 'score': float(score), 'person_id': int(self.gallery.person_ids[i]),
+                         'camera_id': int(self.gallery.camera_ids[i]), 'image_name': None if names is None else str(names[i])}
+                        for score, i in zip(row_scores, row_ids) if i >= 0] for row_scores, row_ids in zip(scores, ids)]
+        self.request_latency.observe(time() - start)
+        return features, matches
+
+    def get_metrics(self):
+        return {'request': self.request_latency.snapshot(), **self.batcher.get_metrics(),
+                'gallery_size': 0 if self.gallery is None else len(self.gallery)}
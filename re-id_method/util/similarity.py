@@ -0,0 +1,44 @@
+import numpy as np
+
+
+def normalize_descriptors(descriptors, eps = 1e-8):
+    """L2-normalizes descriptors row-wise into a contiguous float32 matrix"""
+    descriptors = np.ascontiguousarray(descriptors, dtype = np.float32).reshape(len(descriptors), -1)
+    norms = np.linalg.norm(descriptors, axis = 1, keepdims = True)
+    return descriptors / np.maximum(norms, eps)
+
+
+def get_block_sizes(num_query, num_gallery, memory_budget):
+    """Returns (query rows, gallery rows) of a float32 score tile fitting into memory_budget bytes"""
+    max_elements = max(memory_budget // 4, 1)
+    gallery_block = max(min(num_gallery, max_elements), 1)
+    query_block = max(min(num_query, max_elements // gallery_block), 1)
+    return query_block, gallery_block
+
+
+def iterate_similarity_blocks(query, gallery, memory_budget = 256 * 2 ** 20):
+    """Yields (query slice, gallery slice, score tile) for normalized descriptor matrices"""
+    query_block, gallery_block = get_block_sizes(len(query), len(gallery), memory_budget)
+    for q_start in range(0, len(query), query_block):
+        q_slice = slice(q_start, min(q_start + query_block, len(query)))
+        for g_start in range(0, len(gallery), gallery_block):
+            g_slice = slice(g_start, min(g_start + gallery_block, len(gallery)))
+            yield q_slice, g_slice, query[q_slice] @ gallery[g_slice].T
+
+
+def cosine_similarity_matrix(query, gallery, memory_budget = 256 * 2 ** 20, normalized = False):
+    """Computes the full Q x G cosine similarity matrix with tiled matrix multiplies
+
+    Parameters:
+        query (array)         -- Q x D query descriptors
+        gallery (array)       -- G x D gallery descriptors
+        memory_budget (int)   -- upper bound in bytes for one score tile
+        normalized (bool)     -- skip normalization if descriptors are already L2-normalized
+    """
+    if not normalized:
+        query = normalize_descriptors(query)
+        gallery = normalize_descriptors(gallery)
+    scores = np.empty((len(query), len(gallery)), dtype = np.float32)
+    for q_slice, g_slice, block in iterate_similarity_blocks(query, gallery, memory_budget):
+        scores[q_slice, g_slice] = block
+    return scores
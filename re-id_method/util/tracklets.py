@@ -0,0 +1,41 @@
+import numpy as np
+from tqdm import tqdm
+from util.extraction import embed_batch
+
+
+def pool_tracklets(model, batches, num_tracklets, device, pooling = 'mean', channels_last = False, bf16 = False, projection = None):
+    """Embeds streamed (images, tracklet indices) batches and pools every tracklet into one descriptor
+
+    Frame descriptors are L2-normalized and averaged per tracklet; with pooling 'quality'
+    every frame is weighted by the norm of its raw backbone descriptor, taken before the
+    projection, so frames the backbone responds weakly to (blurred, occluded, mostly
+    background) count less. Only running sums are
+    kept, memory is num_tracklets x D whatever the number of frames.
+
+    Returns (num_tracklets x D float32 descriptors, number of embedded frames of every tracklet).
+    """
+    if pooling not in ['mean', 'quality']:
+        raise ValueError('Unknown tracklet pooling {}'.format(pooling))
+    sums = None
+    weights = np.zeros(num_tracklets, dtype = np.float64)
+    counts = np.zeros(num_tracklets, dtype = np.int64)
+
+    for images, tracklets in tqdm(batches):
+        features = embed_batch(model, images, device, channels_last, bf16)
+        frame_weights = np.linalg.norm(features, axis = 1) if pooling == 'quality' else np.ones(len(features))
+        if projection is not None:
+            features = projection.apply(features)
+        if sums is None:
+            sums = np.zeros((num_tracklets, features.shape[1]), dtype = np.float64)
+        norms = np.linalg.norm(features, axis = 1)
+        weighted = features * (frame_weights / np.maximum(norms, 1e-8))[:, None]
+
+        # frames of a tracklet are consecutive in the stream
+        starts = np.flatnonzero(np.concatenate([[True], tracklets[1:] != tracklets[:-1]]))
+        sums[tracklets[starts]] += np.add.reduceat(weighted, starts)
+        weights[tracklets[starts]] += np.add.reduceat(frame_weights, starts)
+        counts[tracklets[starts]] += np.diff(np.concatenate([starts, [len(tracklets)]]))
+
+    if sums is None:
+        return np.zeros((num_tracklets, 0), dtype = np.float32), counts
+    return (sums / np.maximum(weights, 1e-12)[:, None]).astype(np.float32), counts